@@ -0,0 +1,81 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import platform
+import time
+
+# name -> function(scale) returning a dictionary of metrics
+BENCHMARKS = {}
+
+def benchmark(name):
+    "Register a function(scale) that returns a dictionary of metrics, named after what they measure."
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+def is_rate(metric):
+    "Return whether a greater value of the metric is better. Other metrics are times, where less is better."
+    return metric.endswith('_per_second')
+
+def run(pattern='', repeat=3, scale=1.0, log=None):
+    "Run the benchmarks whose names contain pattern and return a report with the best of repeat runs of each one."
+    results = {}
+    for name in sorted(BENCHMARKS):
+        if pattern not in name:
+            continue
+        best = {}
+        for _ in range(repeat):
+            for metric, value in BENCHMARKS[name](scale).items():
+                if metric not in best or (value > best[metric] if is_rate(metric) else value < best[metric]):
+                    best[metric] = value
+        results[name] = best
+        if log is not None:
+            log('%s %s' % (name, ' '.join('%s=%.6g' % item for item in sorted(best.items()))))
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'scale': scale,
+        'results': results,
+    }
+
+def compare(baseline, report, threshold=0.1):
+    "Return (name, metric, baseline value, value) for every metric of report more than threshold worse than baseline."
+    regressions = []
+    for name, metrics in sorted(report['results'].items()):
+        for metric, value in sorted(metrics.items()):
+            old = baseline['results'].get(name, {}).get(metric)
+            if not old:
+                continue
+            change = (value - old) / float(old)
+            if (change < -threshold) if is_rate(metric) else (change > threshold):
+                regressions.append((name, metric, old, value))
+    return regressions
+
+def timed(function, *args):
+    "Return the seconds taken by function(*args) and its result."
+    started = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - started, result
@@ -0,0 +1,65 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import argparse
+import importlib
+import json
+import sys
+
+import benchmarks
+import benchmarks.suite
+
+def main(argv=None):
+    "Run the benchmarks, optionally saving the report and comparing it with a baseline."
+    arguments = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmark the Knuckleball client.')
+    arguments.add_argument('--filter', default='', help='run only the benchmarks whose names contain this text')
+    arguments.add_argument('--repeat', type=int, default=3, help='keep the best of this many runs of each benchmark')
+    arguments.add_argument('--scale', type=float, default=1.0, help='multiply the size of every workload')
+    arguments.add_argument('--module', action='append', default=[], help='import a module registering more benchmarks')
+    arguments.add_argument('--output', help='save the report as JSON in this file')
+    arguments.add_argument('--compare', help='compare with the report saved in this file')
+    arguments.add_argument('--threshold', type=float, default=0.1, help='relative change considered a regression')
+    arguments.add_argument('--list', action='store_true', help='list the benchmarks and exit')
+    options = arguments.parse_args(argv)
+    for module in options.module:
+        importlib.import_module(module)
+    if options.list:
+        for name in sorted(benchmarks.BENCHMARKS):
+            print(name)
+        return 0
+    report = benchmarks.run(options.filter, options.repeat, options.scale, log=print)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        regressions = benchmarks.compare(baseline, report, options.threshold)
+        for name, metric, old, new in regressions:
+            print('regression: %s %s %.6g -> %.6g' % (name, metric, old, new))
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
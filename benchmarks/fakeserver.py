@@ -0,0 +1,138 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import socket
+import threading
+import time
+
+class FakeServer:
+    def __init__(self, replies=None, default='RuntimeError: invalid message.', handler=None, latency_in_seconds=0.0,
+                 chunk_size=None, record=True, host='127.0.0.1', path=None):
+        "Serve each connection in a thread, replying to every command with handler(command) or replies.get(command)."
+        # A reply of None is never sent. Replies are sent after latency_in_seconds, in writes of chunk_size bytes. The
+        # server listens on a Unix domain socket at path if it is given, and on a TCP port of host otherwise.
+        self.replies = replies if replies is not None else {}
+        self.default = default
+        self.handler = handler
+        self.latency_in_seconds = latency_in_seconds
+        self.chunk_size = chunk_size
+        self.record = record
+        self.commands = []
+        self.connections = []
+        self.path = path
+        if path is None:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._sock.bind((host, 0))
+            self.host = host
+            self.port = self._sock.getsockname()[1]
+            self.url = 'knuckleball://%s:%d' % (host, self.port)
+        else:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.bind(path)
+            self.url = 'knuckleball+unix://' + path
+            self.host = self.url # so that Knuckleball(server.host, server.port) connects to either
+            self.port = None
+        self._sock.listen(128)
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        "Stop accepting connections and close the open ones."
+        self._sock.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+        self.drop_connections()
+
+    def drop_connections(self):
+        "Close the open connections, as a server that restarts would."
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            conn.close()
+        self.connections = []
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except socket.error:
+                return
+            if self.path is None:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections.append(conn)
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _reply(self, command):
+        "Return the reply to a command, or None."
+        if self.handler is not None:
+            return self.handler(command)
+        return self.replies.get(command, self.default)
+
+    def _serve(self, conn):
+        buffer = b''
+        while True:
+            try:
+                received = conn.recv(65536)
+            except socket.error:
+                received = b''
+            if not received:
+                conn.close()
+                return
+            buffer += received
+            lines = buffer.split(b'\n')
+            buffer = lines.pop()
+            replies = []
+            for line in lines:
+                command = line.decode('utf8')
+                if self.record:
+                    self.commands.append(command)
+                reply = self._reply(command)
+                if reply is not None:
+                    replies.append(reply + '\n')
+            if not replies:
+                continue
+            if self.latency_in_seconds:
+                time.sleep(self.latency_in_seconds)
+            data = ''.join(replies).encode('utf8')
+            try:
+                if self.chunk_size is None:
+                    conn.sendall(data)
+                else:
+                    for start in range(0, len(data), self.chunk_size):
+                        conn.sendall(data[start:start + self.chunk_size])
+            except socket.error:
+                conn.close()
+                return
@@ -0,0 +1,171 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import os
+import tempfile
+import threading
+
+from benchmarks import benchmark
+from benchmarks import timed
+from benchmarks.fakeserver import FakeServer
+from knuckleball import connection
+from knuckleball import memo
+from knuckleball import parser
+from knuckleball import schema
+from knuckleball import traffic
+from knuckleball.async_client import AsyncKnuckleball
+from knuckleball.client import Knuckleball
+from knuckleball.pool import KnuckleballPool
+
+def _count(scale, count):
+    "Return count scaled, at least 1."
+    return max(1, int(count * scale))
+
+_REPLIES = {
+    'integers': lambda n: '[%s]' % ','.join(str(i * 7919 - n) for i in range(n)),
+    'floats': lambda n: '[%s]' % ','.join('%d.%d' % (i, i % 1000) for i in range(n)),
+    'strings': lambda n: '{%s}' % ','.join('"name \\"%d\\""' % i for i in range(n)),
+    'dictionary': lambda n: '(%s)' % ','.join('("key%d",%d)' % (i, i) for i in range(n)),
+}
+
+def _parse_benchmark(reply, count, parse):
+    "Register a benchmark of parse on a reply of count elements built by _REPLIES[reply]."
+    def run(scale):
+        n = _count(scale, count)
+        data = _REPLIES[reply](n)
+        seconds, _ = timed(parse, data)
+        return {'elements_per_second': n / seconds, 'megabytes_per_second': len(data) / seconds / 1e6}
+    return run
+
+for _name, _reply, _parse in [
+        ('parse.integers', 'integers', parser.parse),
+        ('parse.floats', 'floats', parser.parse),
+        ('parse.strings', 'strings', parser.parse),
+        ('parse.dictionary', 'dictionary', parser.parse),
+        ('parse.typed.integers', 'integers', schema.Vector[schema.Integer].parse),
+        ('parse.typed.floats', 'floats', schema.Vector[schema.Float].parse),
+        ('parse.typed.strings', 'strings', schema.Set[schema.String].parse),
+        ('parse.typed.dictionary', 'dictionary', schema.Dictionary[schema.String, schema.Integer].parse),
+        ('parse.array.integers', 'integers', schema.Array[schema.Integer].parse),
+        ('parse.array.floats', 'floats', schema.Array[schema.Float].parse)]:
+    benchmark(_name)(_parse_benchmark(_reply, 100000, _parse))
+
+@benchmark('parse.memo')
+def parse_memo(scale):
+    "Parse the same small Dictionary repeatedly, as for a configuration read again and again."
+    n = _count(scale, 100000)
+    data = _REPLIES['dictionary'](50)
+    parse = memo.MemoParser(intern_table=memo.InternTable()).parse
+    seconds, _ = timed(lambda: [parse(data) for _ in range(n)])
+    return {'replies_per_second': n / seconds}
+
+@benchmark('recv.large_line')
+def recv_large_line(scale):
+    "Receive a reply of 16 MB, written by the server in chunks of 64 KiB."
+    reply = 'x' * _count(scale, 16 << 20)
+    with FakeServer({'get': reply}, chunk_size=65536) as server:
+        tcp_connection = connection.TCPConnection(server.host, server.port)
+        tcp_connection.send('get\n')
+        seconds, _ = timed(tcp_connection.recv)
+        tcp_connection.close()
+    return {'megabytes_per_second': (len(reply) + 1) / seconds / 1e6}
+
+def _roundtrip(scale, path=None):
+    "Execute commands one at a time, waiting for each reply, over TCP or the Unix domain socket at path."
+    with FakeServer({'i get;': '42'}, record=False, path=path) as server:
+        knuckleball = Knuckleball(server.url)
+        knuckleball.execute('i get;')
+        latencies = [timed(knuckleball.execute, 'i get;')[0] for _ in range(_count(scale, 5000))]
+        knuckleball.close()
+    total = sum(latencies)
+    latencies.sort()
+    return {
+        'commands_per_second': len(latencies) / total,
+        'p50_seconds': traffic.percentile(latencies, 0.5),
+        'p99_seconds': traffic.percentile(latencies, 0.99),
+    }
+
+@benchmark('roundtrip.latency')
+def roundtrip_latency(scale):
+    "Execute commands over loopback TCP."
+    return _roundtrip(scale)
+
+@benchmark('roundtrip.latency.unix')
+def roundtrip_latency_unix(scale):
+    "Execute commands over a Unix domain socket."
+    directory = tempfile.mkdtemp()
+    try:
+        return _roundtrip(scale, os.path.join(directory, 'kb.sock'))
+    finally:
+        os.rmdir(directory)
+
+@benchmark('pipeline.throughput')
+def pipeline_throughput(scale):
+    "Execute commands in pipelines of 1000."
+    n = _count(scale, 100000)
+    with FakeServer({'i get;': '42'}, record=False) as server:
+        knuckleball = Knuckleball(server.host, server.port)
+        def run():
+            pipeline = knuckleball.pipeline()
+            for _ in range(n):
+                pipeline.add('i get;')
+            return pipeline.execute()
+        seconds, _ = timed(run)
+        knuckleball.close()
+    return {'commands_per_second': n / seconds}
+
+@benchmark('pool.throughput')
+def pool_throughput(scale):
+    "Execute commands from 8 threads sharing a pool of 4 connections."
+    n = _count(scale, 2500)
+    with FakeServer({'i get;': '42'}, record=False) as server:
+        pool = KnuckleballPool(server.host, server.port, max_size=4)
+        def work():
+            for _ in range(n):
+                pool.execute('i get;')
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        def run():
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        seconds, _ = timed(run)
+        stats = pool.stats()
+        pool.close()
+    return {'commands_per_second': 8 * n / seconds, 'wait_seconds_max': stats['wait_seconds_max']}
+
+@benchmark('async.throughput')
+def async_throughput(scale):
+    "Execute concurrent commands on a single asyncio connection."
+    n = _count(scale, 20000)
+    with FakeServer({'i get;': '42'}, record=False) as server:
+        async def run():
+            async with AsyncKnuckleball(server.host, server.port) as knuckleball:
+                await asyncio.gather(*[knuckleball.execute('i get;') for _ in range(n)])
+        loop = asyncio.new_event_loop()
+        try:
+            seconds, _ = timed(loop.run_until_complete, run())
+        finally:
+            loop.close()
+    return {'commands_per_second': n / seconds}
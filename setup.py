@@ -32,4 +32,7 @@ setup(
     description='Python client for Knuckleball data structure server.',
     license='BSD',
     keywords='knuckleball,nosql',
+    entry_points={
+        'console_scripts': ['knuckleball-replay = knuckleball.traffic:main'],
+    },
 )
@@ -0,0 +1,285 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import collections
+import socket
+
+from knuckleball import connection
+from knuckleball import exception
+from knuckleball import serializer
+from knuckleball.client import Knuckleball
+
+async def _parse(data, expect):
+    "Parse a reply, in the UTF-8 bytes received, as the expected type or raise an error."
+    # An expect with submit, such as an offload.ProcessParser, parses elsewhere, so its Future is awaited instead of
+    # blocking the event loop.
+    if hasattr(expect, 'submit'):
+        return await asyncio.wrap_future(expect.submit(data))
+    return Knuckleball._parse(data, expect)
+
+class AsyncKnuckleball:
+    def __init__(self, host, port=None, timeout_in_seconds=None, password=None, read_limit=2 ** 30,
+                 send_buffer_size=None, receive_buffer_size=None):
+        "Keep the parameters of a connection with the Knuckleball server, at host and port or a URL in host."
+        self._host = host
+        self._port = port
+        self._timeout_in_seconds = timeout_in_seconds
+        self._password = password
+        self._read_limit = read_limit
+        self._send_buffer_size = send_buffer_size
+        self._receive_buffer_size = receive_buffer_size
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._waiters = collections.deque()
+        self._error = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def __len__(self):
+        "Return the number of commands waiting for their replies."
+        return len(self._waiters)
+
+    async def connect(self):
+        "Set a connection with the Knuckleball server and authenticate, or raise an error."
+        if self._port is not None:
+            connecting = asyncio.open_connection(self._host, self._port, limit=self._read_limit)
+        else:
+            url = connection.urlsplit(self._host)
+            if url.scheme in ('knuckleball', 'knuckleball+tcp'):
+                connecting = asyncio.open_connection(url.hostname, url.port, limit=self._read_limit)
+            elif url.scheme == 'knuckleball+unix':
+                connecting = asyncio.open_unix_connection(url.path, limit=self._read_limit)
+            else:
+                raise ValueError('unsupported URL %s.' % self._host)
+        self._reader, self._writer = await asyncio.wait_for(connecting, self._timeout_in_seconds)
+        sock = self._writer.get_extra_info('socket')
+        if sock is not None:
+            # asyncio opens the socket, so its buffer sizes are set once it is connected.
+            connection._set_buffer_sizes(sock, self._send_buffer_size, self._receive_buffer_size)
+            if sock.family in (socket.AF_INET, socket.AF_INET6):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._error = None
+        self._reader_task = asyncio.ensure_future(self._read_replies())
+        if self._password:
+            await self.execute('Connection authenticateWithPassword: %s;' % serializer.serialize_string(self._password))
+
+    async def close(self):
+        "Close the connection, failing the commands still waiting for their replies."
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._reader_task.cancel()
+        try:
+            await self._reader_task
+        except asyncio.CancelledError:
+            pass
+        self._fail_waiters(socket.error('connection closed.'))
+        self._writer = None
+
+    def is_connected(self):
+        "Return whether the connection is open."
+        return self._writer is not None and self._error is None
+
+    async def _read_replies(self):
+        "Resolve the waiting commands in order with the replies read from the server."
+        try:
+            while True:
+                line = await self._reader.readuntil(b'\n')
+                if not self._waiters:
+                    raise socket.error('unexpected reply.')
+                waiter = self._waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(line[:-1])
+        except asyncio.IncompleteReadError:
+            self._fail_waiters(socket.error('connection closed by foreign host.'))
+        except (asyncio.LimitOverrunError, OSError) as e:
+            self._fail_waiters(e)
+
+    def _fail_waiters(self, error):
+        "Fail every command waiting for its reply with error."
+        self._error = error
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(error)
+
+    def _send(self, commands):
+        "Write commands to the server and return the futures of their replies."
+        if self._writer is None:
+            raise socket.error('not connected.')
+        if self._error is not None:
+            raise self._error
+        loop = asyncio.get_event_loop()
+        waiters = [loop.create_future() for _ in commands]
+        self._writer.write(''.join(command + '\n' for command in commands).encode('utf8'))
+        self._waiters.extend(waiters)
+        return waiters
+
+    async def execute(self, command, expect=None):
+        "Execute a command in the Knuckleball server and return the result, of the expected type, or raise an error."
+        waiter, = self._send([command])
+        await self._writer.drain()
+        # A cancelled waiter keeps its place in the queue, so its reply is still read and dropped.
+        data = await asyncio.wait_for(asyncio.shield(waiter), self._timeout_in_seconds)
+        return await _parse(data, expect)
+
+    def pipeline(self, max_commands=1000):
+        "Return a pipeline that sends queued commands to the Knuckleball server in a single write."
+        return AsyncPipeline(self, max_commands)
+
+class AsyncPipeline:
+    def __init__(self, knuckleball, max_commands=1000):
+        "Queue commands for the client, sending them whenever max_commands are queued."
+        self._knuckleball = knuckleball
+        self._max_commands = max_commands
+        self._commands = []
+        self._expects = []
+        self._waiters = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        "Send the commands still queued, unless the block raised an error."
+        if exc_type is None:
+            await self.flush()
+
+    def __len__(self):
+        return len(self._commands)
+
+    async def add(self, command, expect=None):
+        "Queue a command, whose result is of the expected type, and return the pipeline."
+        self._commands.append(command)
+        self._expects.append(expect)
+        if len(self._commands) >= self._max_commands:
+            await self.flush()
+        return self
+
+    async def flush(self):
+        "Send the queued commands in a single write without waiting for their results."
+        if not self._commands:
+            return
+        commands, self._commands = self._commands, []
+        expects, self._expects = self._expects, []
+        self._waiters.extend(zip(self._knuckleball._send(commands), expects))
+        await self._knuckleball._writer.drain()
+
+    async def execute(self):
+        "Send the queued commands and return every result since the last call, with errors in place of results."
+        await self.flush()
+        waiters, self._waiters = self._waiters, []
+        results = []
+        for waiter, expect in waiters:
+            try:
+                results.append(await _parse(await waiter, expect))
+            except exception.KnuckleballException as e:
+                results.append(e)
+        return results
+
+class AsyncKnuckleballPool:
+    def __init__(self, host, port=None, timeout_in_seconds=None, password=None, size=4, read_limit=2 ** 30,
+                 send_buffer_size=None, receive_buffer_size=None):
+        "Spread commands over up to size connections with the Knuckleball server, each one with many in flight."
+        self._host = host
+        self._port = port
+        self._timeout_in_seconds = timeout_in_seconds
+        self._password = password
+        self._read_limit = read_limit
+        self._send_buffer_size = send_buffer_size
+        self._receive_buffer_size = receive_buffer_size
+        self._connections = [None] * size
+        self._connecting = [None] * size
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _connection(self, index):
+        "Return the connection at index, opening it if it is missing or broken."
+        knuckleball = self._connections[index]
+        if knuckleball is not None and knuckleball.is_connected():
+            return knuckleball
+        if self._connecting[index] is None:
+            self._connecting[index] = asyncio.ensure_future(self._connect(index))
+        return await asyncio.shield(self._connecting[index])
+
+    async def _connect(self, index):
+        "Replace the connection at index with a new one."
+        try:
+            if self._connections[index] is not None:
+                await self._connections[index].close()
+                self._connections[index] = None
+            knuckleball = AsyncKnuckleball(self._host, self._port, self._timeout_in_seconds, self._password,
+                                           self._read_limit, self._send_buffer_size, self._receive_buffer_size)
+            await knuckleball.connect()
+            self._connections[index] = knuckleball
+            return knuckleball
+        finally:
+            self._connecting[index] = None
+
+    def _least_loaded(self):
+        "Return the index of the connection with the fewest commands in flight, preferring open ones."
+        def load(index):
+            knuckleball = self._connections[index]
+            if knuckleball is None or not knuckleball.is_connected():
+                return (1, 0)
+            return (0, len(knuckleball))
+        return min(range(len(self._connections)), key=load)
+
+    async def acquire(self):
+        "Return an idle connection, or open a new one while the pool is not full, or the least loaded connection."
+        best = self._least_loaded()
+        knuckleball = self._connections[best]
+        if knuckleball is not None and knuckleball.is_connected() and len(knuckleball) == 0:
+            return knuckleball
+        for index, knuckleball in enumerate(self._connections):
+            if knuckleball is None and self._connecting[index] is None:
+                return await self._connection(index)
+        return await self._connection(best)
+
+    async def execute(self, command, expect=None):
+        "Execute a command in the least loaded connection and return the result or raise an error."
+        knuckleball = await self.acquire()
+        return await knuckleball.execute(command, expect)
+
+    def stats(self):
+        "Return a dictionary with the number of open connections and of commands in flight on each of them."
+        in_flight = [len(knuckleball) for knuckleball in self._connections
+                     if knuckleball is not None and knuckleball.is_connected()]
+        return {'size': len(in_flight), 'max_size': len(self._connections), 'in_flight': in_flight}
+
+    async def close(self):
+        "Close every connection."
+        for index, knuckleball in enumerate(self._connections):
+            if knuckleball is not None:
+                await knuckleball.close()
+                self._connections[index] = None
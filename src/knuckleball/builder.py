@@ -0,0 +1,114 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import re
+
+from knuckleball import schema
+from knuckleball import serializer
+
+_IDENTIFIER = re.compile(r'[^\W\d_]\w*\Z', re.U)
+
+class CommandTemplate:
+    def __init__(self, template, expect=None):
+        "Compile a command in which every '%s' stands for the literal of an argument, and the type of its result."
+        self._pieces = tuple(template.split('%s'))
+        self.expect = expect
+
+    def render(self, *arguments):
+        "Return the command with the Knuckleball literals of arguments or raise an error."
+        if len(arguments) != len(self._pieces) - 1:
+            raise TypeError('%d arguments expected, got %d.' % (len(self._pieces) - 1, len(arguments)))
+        if not arguments:
+            return self._pieces[0]
+        serialize = serializer.serialize
+        parts = [self._pieces[0]]
+        for argument, piece in zip(arguments, self._pieces[1:]):
+            parts.append(serialize(argument))
+            parts.append(piece)
+        return ''.join(parts)
+
+class Command:
+    def __init__(self, knuckleball, template):
+        "Bind a command template to a client."
+        self._knuckleball = knuckleball
+        self._template = template
+
+    def __call__(self, *arguments):
+        "Execute the command with arguments and return the result or raise an error."
+        return self._knuckleball.execute(self._template.render(*arguments), self._template.expect)
+
+class Variable:
+    # method -> (message, type of the result, where None is the type of the variable)
+    MESSAGES = {
+        'get': ('get', None),
+        'set': ('set: %s', schema.Null),
+        'add': ('add: %s', schema.Null),
+        'remove': ('remove: %s', schema.Null),
+        'contains': ('contains? %s', schema.Boolean),
+    }
+
+    def __init__(self, knuckleball, name, ns=None, type=None):
+        "Build commands for the variable name in the namespace ns, or raise an error if they are not identifiers."
+        for identifier in (name, ns):
+            if identifier is not None and _IDENTIFIER.match(identifier) is None:
+                raise ValueError('%r is not an identifier.' % identifier)
+        self._knuckleball = knuckleball
+        self.name = name if ns is None else '%s::%s' % (ns, name)
+        self.type = type
+
+    def command(self, message, expect=None):
+        "Return the compiled command sending a message, in which '%s' stands for an argument, to the variable."
+        return Command(self._knuckleball, self._knuckleball._template('%s %s;' % (self.name, message), expect))
+
+    def _execute(self, method, *arguments):
+        "Execute the command of a method in MESSAGES and return the result or raise an error."
+        message, expect = Variable.MESSAGES[method]
+        return self.command(message, expect or self.type)(*arguments)
+
+    def create(self, type_name, value=None):
+        "Create the variable with a type, such as 'Set<String>', and an optional initial value."
+        if value is None:
+            return Command(self._knuckleball, self._knuckleball._template(
+                '%s create: %s;' % (type_name, self.name), schema.Null))()
+        return Command(self._knuckleball, self._knuckleball._template(
+            '%s create: %s withValue: %%s;' % (type_name, self.name), schema.Null))(value)
+
+    def get(self):
+        "Return the value of the variable."
+        return self._execute('get')
+
+    def set(self, value):
+        "Set the value of the variable."
+        return self._execute('set', value)
+
+    def add(self, value):
+        "Add a value to the variable."
+        return self._execute('add', value)
+
+    def remove(self, value):
+        "Remove a value from the variable."
+        return self._execute('remove', value)
+
+    def contains(self, value):
+        "Return whether the variable contains a value."
+        return self._execute('contains', value)
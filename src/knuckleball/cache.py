@@ -0,0 +1,157 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import re
+import threading
+import time
+
+_now = getattr(time, 'monotonic', time.time)
+
+# Literals are kept as they are, and any other run of whitespace is replaced by a single space.
+_WHITESPACE = re.compile(r'''("[^"\\]*(?:\\.[^"\\]*)*"|'.')|\s+''', re.S | re.U)
+_TARGET = re.compile(r'([^\W\d_]\w*(?:::[^\W\d_]\w*)?)(<)?', re.U)
+_MESSAGE = re.compile(r'[^\s;]+', re.U)
+_CLASSES = frozenset(['Boolean', 'Character', 'Integer', 'Float', 'String', 'Vector', 'Set', 'Dictionary', 'Context',
+                      'Connection'])
+
+READ_MESSAGES = frozenset(['get', 'contains?', 'size', 'isEmpty', 'listVariables', 'listNamespaces'])
+
+def normalize(command):
+    "Return the command with its whitespace outside literals collapsed."
+    return _WHITESPACE.sub(lambda match: match.group(1) or ' ', command).strip()
+
+def split(command):
+    "Return the variable targeted by a normalized command, or None if it targets a class, and its first message."
+    match = _TARGET.match(command)
+    if match is None:
+        return None, None
+    variable = match.group(1)
+    pos = match.end()
+    if match.group(2) or variable in _CLASSES:
+        variable = None
+        depth = 1 if match.group(2) else 0
+        while depth and pos < len(command):
+            depth += {'<': 1, '>': -1}.get(command[pos], 0)
+            pos += 1
+    message = _MESSAGE.search(command, pos)
+    return variable, message.group(0) if message else None
+
+def _copy(value):
+    "Return a copy of a container, so callers cannot change the cached one."
+    if isinstance(value, (list, set, dict)):
+        return type(value)(value)
+    return value
+
+class CachedKnuckleball:
+    def __init__(self, knuckleball, max_entries=1024, ttl_in_seconds=None, read_messages=READ_MESSAGES):
+        "Cache the results of read commands executed by knuckleball, a Knuckleball or a KnuckleballPool."
+        self._knuckleball = knuckleball
+        self._max_entries = max_entries
+        self._ttl_in_seconds = ttl_in_seconds
+        self._read_messages = read_messages
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict() # (command, expected type) -> (result, expiration, variable)
+        self._keys = {} # variable -> set of (command, expected type)
+        self._generation = 0 # incremented on every invalidation, so results read before it are not cached
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def execute(self, command, expect=None, cache=True):
+        "Execute a command, or return its cached result if it is a read, and invalidate the results it may change."
+        normalized = normalize(command)
+        variable, message = split(normalized)
+        if message not in self._read_messages:
+            try:
+                return self._knuckleball.execute(command, expect)
+            finally:
+                self.invalidate(variable)
+        if not cache:
+            return self._knuckleball.execute(command, expect)
+        key = (normalized, expect)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry[1] is None or entry[1] > _now():
+                    self._entries[key] = entry
+                    self._hits += 1
+                    return _copy(entry[0])
+                self._forget(key, entry[2])
+                self._evictions += 1
+            self._misses += 1
+            generation = self._generation
+        result = self._knuckleball.execute(command, expect)
+        expiration = None if self._ttl_in_seconds is None else _now() + self._ttl_in_seconds
+        with self._lock:
+            if generation != self._generation:
+                return result
+            if key in self._entries:
+                self._forget(key, self._entries.pop(key)[2])
+            self._entries[key] = (_copy(result), expiration, variable)
+            self._keys.setdefault(variable, set()).add(key)
+            while len(self._entries) > self._max_entries:
+                old_key, old_entry = self._entries.popitem(last=False)
+                self._forget(old_key, old_entry[2])
+                self._evictions += 1
+        return result
+
+    def _forget(self, key, variable):
+        "Remove a command from the index of its variable."
+        keys = self._keys[variable]
+        keys.discard(key)
+        if not keys:
+            del self._keys[variable]
+
+    def invalidate(self, variable=None):
+        "Drop the cached results of a variable, or every cached result if variable is None."
+        with self._lock:
+            self._generation += 1
+            if variable is None:
+                self._invalidations += len(self._entries)
+                self._entries.clear()
+                self._keys.clear()
+                return
+            for key in self._keys.pop(variable, ()):
+                del self._entries[key]
+                self._invalidations += 1
+            # Commands on classes, such as 'Context listVariables;', may depend on any variable.
+            for key in self._keys.pop(None, ()):
+                del self._entries[key]
+                self._invalidations += 1
+
+    def stats(self):
+        "Return a dictionary with the number of cached results, hits, misses, evictions and invalidations."
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'invalidations': self._invalidations,
+            }
+
+    def close(self):
+        "Close the wrapped client."
+        self._knuckleball.close()
@@ -21,232 +21,389 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import time
+
+from knuckleball import builder
 from knuckleball import connection
 from knuckleball import exception
+from knuckleball import metrics
+from knuckleball import parser
+from knuckleball import serializer
 
-class Knuckleball:
-    def __init__(self, host, port, timeout_in_seconds=None, password=None):
-        "Set a TCP connection with the Knuckleball server or raise an error."
-        self._tcp_connection = connection.TCPConnection(host, port, timeout_in_seconds)
-        if password:
-            self.execute('Connection authenticateWithPassword: "%s";' % password)
-
-    def execute(self, command):
-        "Execute a command in the Knuckleball server and return the result or raise an error."
-        self._tcp_connection.send(command + "\n")
-        data = self._tcp_connection.recv()
-        return Knuckleball.parse(data)
-
-    @staticmethod
-    def parse(data):
-        if Knuckleball._is_null(data):
-            return None
-        if Knuckleball._is_boolean(data):
-            return Knuckleball._parse_boolean(data)
-        if Knuckleball._is_character(data):
-            return Knuckleball._parse_character(data)
-        if Knuckleball._is_integer(data):
-            return Knuckleball._parse_integer(data)
-        if Knuckleball._is_float(data):
-            return Knuckleball._parse_float(data)
-        if Knuckleball._is_string(data):
-            return Knuckleball._parse_string(data)
-        if Knuckleball._is_vector(data):
-            return Knuckleball._parse_vector(data)
-        if Knuckleball._is_set(data):
-            return Knuckleball._parse_set(data)
-        if Knuckleball._is_dictionary(data):
-            return Knuckleball._parse_dictionary(data)
-        if Knuckleball._is_error(data):
-            raise exception.KnuckleballException(data)
-        raise exception.KnuckleballException('invalid value.')
-
-    @staticmethod
-    def _is_null(data):
-        return data == "null"
-
-    @staticmethod
-    def _is_error(data):
-        return data.startswith('SyntaxError:') or data.startswith('RuntimeError:') or \
-               data.startswith('AuthenticationError:')
+_now = getattr(time, 'perf_counter', time.time)
 
-    @staticmethod
-    def _is_boolean(data):
-        return data in ('true', 'false')
-
-    @staticmethod
-    def _parse_boolean(data):
-        return data == 'true'
+def _parses_bytes(expect):
+    "Return whether replies parsed as expect are to be handed to it in the UTF-8 bytes received."
+    # Such as an offload.ProcessParser, which has submit and copies them for its workers, or schema.Lazy, which has
+    # parse_bytes and keeps them.
+    return hasattr(expect, 'submit') or hasattr(expect, 'parse_bytes')
 
-    @staticmethod
-    def _is_character(data):
-        return len(data) == 3 and data[0] == "'" and data[2] == "'"
-
-    @staticmethod
-    def _parse_character(data):
-        return data[1]
-
-    @staticmethod
-    def _is_integer(data):
-        return data.isdigit() or (len(data) > 1 and data[0] in ('+', '-') and data[1:].isdigit())
-
-    @staticmethod
-    def _parse_integer(data):
-        return int(data)
-
-    @staticmethod
-    def _is_float(data):
-        return Knuckleball._is_integer(data) or (data.find('.') >= 0 and
-               Knuckleball._is_integer(data[:data.find('.')]) and Knuckleball._is_integer(data[data.find('.') + 1:]))
-
-    @staticmethod
-    def _parse_float(data):
-        return float(data)
-
-    @staticmethod
-    def _is_string(data):
-        if len(data) > 1 and data[0] == '"' and data[-1] == '"':
-            for i in range(1, len(data) - 1):
-                if data[i] == '"':
-                    for j in range(i - 1, -1, -1):
-                        if data[j] != '\\':
-                            if (i - j) % 2 == 1:
-                                return False
-                            break
-            for i in range(len(data) - 2, 0, -1):
-                if data[i] != '\\':
-                    return (len(data) - 1 - i) % 2 == 1
-            return len(data) % 2 == 0
-        return False
-            
-    @staticmethod
-    def _parse_string(data):
-        data = data[1:-1]
-        value = ""
-        for i in range(len(data)):
-            if i < len(data) - 1 and data[i] == '\\' and data[i + 1] == '"':
+class Knuckleball:
+    def __init__(self, host, port=None, timeout_in_seconds=None, password=None, read_size=65536, hooks=(),
+                 spill_threshold=None, connect_timeout_in_seconds=None, send_buffer_size=None,
+                 receive_buffer_size=None):
+        "Set a connection with the Knuckleball server, at host and port or a URL in host, or raise an error."
+        # Replies longer than spill_threshold bytes are received into a memory-mapped temporary file and parsed there.
+        self._connection = connection.open_connection(
+            host, port, timeout_in_seconds=timeout_in_seconds, read_size=read_size, spill_threshold=spill_threshold,
+            connect_timeout_in_seconds=connect_timeout_in_seconds, send_buffer_size=send_buffer_size,
+            receive_buffer_size=receive_buffer_size)
+        self._pending_replies = 0
+        self._templates = {}
+        self._hooks = ()
+        if password:
+            self.execute('Connection authenticateWithPassword: %s;' % serializer.serialize_string(password))
+        # Hooks are set after authenticating, so they never see the password.
+        self._hooks = tuple(hooks)
+
+    def add_hook(self, hook):
+        "Call hook.before(command) and hook.after(event), where event is a metrics.CommandEvent, around each command."
+        self._hooks += (hook,)
+
+    def remove_hook(self, hook):
+        "Stop calling a hook."
+        self._hooks = tuple(h for h in self._hooks if h is not hook)
+
+    def execute(self, command, expect=None):
+        "Execute a command in the Knuckleball server and return the result, of the expected type, or raise an error."
+        if self._hooks:
+            return self._execute_with_hooks(command, expect)
+        return Knuckleball._parse(self._request(command, _parses_bytes(expect)), expect)
+
+    def _execute_with_hooks(self, command, expect, submit=False):
+        "Execute a command as execute, or submit if submit is set, does, timing each of its phases for the hooks."
+        hooks = self._hooks
+        for hook in hooks:
+            hook.before(command)
+        transport = self._connection
+        times = [_now()] # when the command started and each of send, wait, receive and parse ended
+        bytes_received = 0
+        error = None
+        try:
+            self._pending_replies += 1
+            transport.send(command + "\n")
+            times.append(_now())
+            transport.wait()
+            times.append(_now())
+            data = transport.recv_bytes() if _parses_bytes(expect) else transport.recv()
+            times.append(_now())
+            self._pending_replies -= 1
+            bytes_received = transport._line_size
+            result = expect.submit(data) if submit else Knuckleball._parse(data, expect)
+            times.append(_now())
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            seconds = [end - start for start, end in zip(times, times[1:])]
+            seconds += [None] * (4 - len(seconds))
+            if error is not None and len(times) == 4:
+                seconds[3] = _now() - times[3] # the parser raised the error
+            event = metrics.CommandEvent(command, seconds[0], seconds[1], seconds[2], seconds[3],
+                                         len(command.encode('utf8')) + 1, bytes_received, error)
+            for hook in hooks:
+                hook.after(event)
+
+    def _request(self, command, as_bytes=False):
+        "Send a command to the Knuckleball server and return its reply, as undecoded bytes if as_bytes is set."
+        # Replies to be parsed from bytes, as _parses_bytes tells, are not decoded only for their parser to encode them.
+        self._pending_replies += 1
+        self._connection.send(command + "\n")
+        data = self._connection.recv_bytes() if as_bytes else self._connection.recv()
+        self._pending_replies -= 1
+        return data
+
+    def submit(self, command, expect):
+        "Execute a command and return a Future of its result, which expect, such as an offload.ProcessParser, parses."
+        # The reply is handed to expect as the bytes received, or a Spill, without being decoded here. For the hooks,
+        # handing it over is its parse phase.
+        if self._hooks:
+            return self._execute_with_hooks(command, expect, submit=True)
+        self._pending_replies += 1
+        self._connection.send(command + "\n")
+        data = self._connection.recv_bytes()
+        self._pending_replies -= 1
+        return expect.submit(data)
+
+    def var(self, name, ns=None, type=None):
+        "Return a builder of commands for a variable of a type, such as var('ages', ns='std').get()."
+        return builder.Variable(self, name, ns, type)
+
+    def command(self, template, expect=None):
+        "Return a compiled command, in which '%s' stands for an argument, such as command('players add: %s;')."
+        return builder.Command(self, self._template(template, expect))
+
+    def _template(self, template, expect):
+        "Return the compiled template, compiling it once."
+        key = (template, expect)
+        compiled = self._templates.get(key)
+        if compiled is None:
+            if len(self._templates) >= 1024:
+                self._templates.clear()
+            compiled = self._templates[key] = builder.CommandTemplate(template, expect)
+        return compiled
+
+    def execute_iter(self, command):
+        "Execute a command and yield the elements or (key, value) pairs of the resulting container as they arrive."
+        hooks = self._hooks
+        for hook in hooks:
+            hook.before(command)
+        # With hooks, the seconds spent receiving and parsing the reply, which happen together, are added up as its
+        # receive seconds, leaving out those the caller spends between values.
+        times = [_now()] # when the command started and was sent
+        receive_seconds = 0.0
+        error = None
+        try:
+            self._pending_replies += 1
+            self._connection.send(command + "\n")
+            times.append(_now())
+            chunks = self._connection.recv_chunks()
+            values = parser.iterparse(chunks)
+            try:
+                while True:
+                    started = _now() if hooks else None
+                    try:
+                        value = next(values)
+                    except StopIteration:
+                        break
+                    finally:
+                        if hooks:
+                            receive_seconds += _now() - started
+                    yield value
+            except (exception.KnuckleballException, GeneratorExit) as e:
+                for _ in chunks: # read the rest of the reply, so the next command gets its own
+                    pass
+                self._pending_replies -= 1
+                if isinstance(e, exception.KnuckleballException):
+                    error = e
+                raise
+            self._pending_replies -= 1
+        except Exception as e:
+            error = error or e
+            raise
+        finally:
+            if hooks:
+                sent = len(times) > 1
+                event = metrics.CommandEvent(command, times[1] - times[0] if sent else None, None,
+                                             receive_seconds if sent else None, None, len(command.encode('utf8')) + 1,
+                                             self._connection._line_size if sent else 0, error)
+                for hook in hooks:
+                    hook.after(event)
+
+    def pipeline(self, max_commands=1000, max_bytes=1 << 20):
+        "Return a pipeline that sends queued commands to the Knuckleball server in a single write."
+        return Pipeline(self, max_commands, max_bytes)
+
+    def bulk_load(self, variable, iterable, message='add:', max_commands=1000, max_bytes=1 << 20, progress=None):
+        "Send 'variable message item;' for each item in pipelined batches and return loaded, [(index, item, error)]."
+        # A message with placeholders, such as 'set: %s withValue: %s', is filled with the elements of each item.
+        loaded = 0
+        failures = []
+        batch = []
+        pipeline = self.pipeline(max_commands, max_bytes)
+        placeholders = '%s' in message
+        template = self._template('%s %s;' % (variable, message if placeholders else message + ' %s'), None)
+        for index, item in enumerate(iterable):
+            try:
+                command = template.render(*(item if placeholders and isinstance(item, tuple) else (item,)))
+            except (TypeError, ValueError) as e:
+                failures.append((index, item, e))
                 continue
-            value += data[i]
-        return value
-
-    @staticmethod
-    def _is_identifier(data):
-        if len(data) == 0 or not data[0].isalpha():
-            return False
-        for c in data[1:]:
-            if not c.isalpha() and not c.isdigit() and c != '_':
-                return False
-        return True
-
-    @staticmethod
-    def _is_namespace(data):
-        return Knuckleball._is_identifier(data)
+            batch.append((index, item))
+            pipeline.add(command)
+            if len(pipeline) == 0:
+                loaded += Knuckleball._check_batch(batch, pipeline.execute(), failures)
+                batch = []
+                if progress is not None:
+                    progress(loaded, len(failures))
+        if batch:
+            loaded += Knuckleball._check_batch(batch, pipeline.execute(), failures)
+            if progress is not None:
+                progress(loaded, len(failures))
+        return loaded, failures
 
     @staticmethod
-    def _is_variable(data):
-        for i in range(len(data) - 1):
-            if data[i] == ':' and data[i + 1] == ':':
-                return Knuckleball._is_namespace(data[:i]) and Knuckleball._is_identifier(data[i + 2:])
-        return Knuckleball._is_identifier(data)
-
-    @staticmethod
-    def _is_value(data):
-        return Knuckleball._is_boolean(data) or Knuckleball._is_character(data) or Knuckleball._is_integer(data) or \
-               Knuckleball._is_float(data) or Knuckleball._is_string(data) or Knuckleball._is_namespace(data) or \
-               Knuckleball._is_variable(data)
-
-    @staticmethod
-    def _parse_value(data):
-        if Knuckleball._is_boolean(data):
-            return Knuckleball._parse_boolean(data)
-        if Knuckleball._is_character(data):
-            return Knuckleball._parse_character(data)
-        if Knuckleball._is_integer(data):
-            return Knuckleball._parse_integer(data)
-        if Knuckleball._is_float(data):
-            return Knuckleball._parse_float(data)
-        if Knuckleball._is_string(data):
-            return Knuckleball._parse_string(data)
-        if Knuckleball._is_namespace(data) or Knuckleball._is_variable(data):
-            return data
-
-    @staticmethod
-    def _is_comma_separated_values(data):
-        for i in range(len(data)):
-            if data[i] == ',' and Knuckleball._is_value(data[:i]) and \
-               Knuckleball._is_comma_separated_values(data[i + 1:]):
-                return True
-        return not data or Knuckleball._is_value(data)
-
-    @staticmethod
-    def _parse_comma_separated_values(data):
-        values = []
-        while data:
-            for i in range(len(data)):
-                if data[i] == ',' and Knuckleball._is_value(data[:i]):
-                    values.append(Knuckleball._parse_value(data[:i]))
-                    data = data[i + 1:]
-                    break
+    def _check_batch(batch, results, failures):
+        "Append to failures the items of a batch whose results are errors and return the number of the others."
+        loaded = 0
+        for (index, item), result in zip(batch, results):
+            if isinstance(result, exception.KnuckleballException):
+                failures.append((index, item, result))
             else:
-                values.append(Knuckleball._parse_value(data))
-                data = ''
-        return values
+                loaded += 1
+        return loaded
 
-    @staticmethod
-    def _is_tuple(data):
-        return len(data) > 1 and data[0] == '(' and data[-1] == ')' and \
-               Knuckleball._is_comma_separated_values(data[1:-1]) and \
-               len(Knuckleball._parse_comma_separated_values(data[1:-1])) == 2
+    def close(self):
+        "Close the connection with the Knuckleball server."
+        self._connection.close()
 
-    @staticmethod
-    def _parse_tuple(data):
-        return Knuckleball._parse_comma_separated_values(data[1:-1])
+    def is_healthy(self):
+        "Return whether every command sent had its reply read and the connection is still open."
+        return self._pending_replies == 0 and self._connection.is_idle()
 
     @staticmethod
-    def _is_comma_separated_tuples(data):
-        for i in range(len(data)):
-            if data[i] == ',' and Knuckleball._is_tuple(data[:i]) and \
-               Knuckleball._is_comma_separated_tuples(data[i + 1:]):
-                return True
-        return not data or Knuckleball._is_tuple(data)
-
-    @staticmethod
-    def _parse_comma_separated_tuples(data):
-        values = []
-        while data:
-            for i in range(len(data)):
-                if data[i] == ',' and Knuckleball._is_tuple(data[:i]):
-                    values.append(Knuckleball._parse_tuple(data[:i]))
-                    data = data[i + 1:]
-                    break
-            else:
-                values.append(Knuckleball._parse_tuple(data))
-                data = ''
-        return values
-
-    @staticmethod
-    def _is_vector(data):
-        return len(data) > 1 and data[0] == '[' and data[-1] == ']' and \
-               Knuckleball._is_comma_separated_values(data[1:-1])
-
-    @staticmethod
-    def _parse_vector(data):
-        return Knuckleball._parse_comma_separated_values(data[1:-1])
-
-    @staticmethod
-    def _is_set(data):
-        return len(data) > 1 and data[0] == '{' and data[-1] == '}' and \
-               Knuckleball._is_comma_separated_values(data[1:-1])
+    def parse(data):
+        "Parse a response of the Knuckleball server and return its value or raise an error."
+        return parser.parse(data)
 
     @staticmethod
-    def _parse_set(data):
-        return set(Knuckleball._parse_comma_separated_values(data[1:-1]))
+    def _parse(data, expect):
+        "Parse a response, as text, UTF-8 bytes from recv_bytes or a Spill, as the expected type."
+        if isinstance(data, connection.Spill):
+            return Knuckleball._parse_spill(data, expect)
+        if isinstance(data, bytes):
+            if hasattr(expect, 'parse_bytes'):
+                return expect.parse_bytes(data)
+            if not hasattr(expect, 'submit'):
+                data = data.decode('utf8')
+        return parser.parse(data) if expect is None else expect.parse(data)
 
     @staticmethod
-    def _is_dictionary(data):
-        return len(data) > 1 and data[0] == '(' and data[-1] == ')' and \
-               Knuckleball._is_comma_separated_tuples(data[1:-1])
+    def _parse_spill(spill, expect):
+        "Parse a response received into a memory-mapped file, closing it unless the result still reads from it."
+        parse_spill = getattr(expect, 'parse_spill', None)
+        if parse_spill is not None:
+            return parse_spill(spill)
+        with spill:
+            if expect is None:
+                container = {b'[': list, b'{': set, b'(': dict}.get(spill.buffer[:1])
+                if container is not None:
+                    return container(parser.iterparse(spill.chunks()))
+                return parser.parse(spill.decode())
+            return expect.parse(spill.decode())
+
+class Pipeline:
+    def __init__(self, knuckleball, max_commands=1000, max_bytes=1 << 20):
+        "Queue commands for the client, sending them whenever max_commands or max_bytes are queued."
+        self._knuckleball = knuckleball
+        self._max_commands = max_commands
+        self._max_bytes = max_bytes
+        self._commands = []
+        self._expects = []
+        self._size = 0
+        self._results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        "Send the commands still queued, unless the block raised an error."
+        if exc_type is None:
+            self.flush()
+
+    def __len__(self):
+        return len(self._commands)
+
+    def add(self, command, expect=None):
+        "Queue a command, whose result is of the expected type, and return the pipeline."
+        self._commands.append(command)
+        self._expects.append(expect)
+        self._size += len(command) + 1
+        if len(self._commands) >= self._max_commands or self._size >= self._max_bytes:
+            self.flush()
+        return self
+
+    def flush(self):
+        "Send the queued commands in a single write and read their results."
+        if not self._commands:
+            return
+        commands, self._commands = self._commands, []
+        expects, self._expects = self._expects, []
+        self._size = 0
+        hooks = self._knuckleball._hooks
+        for hook in hooks:
+            for command in commands:
+                hook.before(command)
+        # With hooks, the receive and parse seconds, size and error of each reply are kept for its CommandEvent.
+        replies = [] if hooks else None
+        sizes = [] if hooks else None
+        times = [_now()] # when the commands started and were sent
+        error = None
+        try:
+            transport = self._knuckleball._connection
+            self._knuckleball._pending_replies += len(commands)
+            transport.send(''.join(command + '\n' for command in commands))
+            times.append(_now())
+            self._read(transport, len(commands), expects, replies, sizes)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if hooks:
+                Pipeline._after(hooks, commands, times, replies, sizes, error)
+
+    def _read(self, transport, remaining, expects, replies, sizes):
+        "Read the replies of the commands sent and append their results, and their timings to replies if it is a list."
+        # Replies are received as bytes if any of them is parsed from bytes, as _parses_bytes tells, and the others are
+        # decoded by _parse.
+        decode = memoryview.tobytes if any(_parses_bytes(expect) for expect in expects) else None
+        expects = iter(expects)
+        first = len(self._results)
+        futures = [] # (position in results, Future) of the results parsed in other processes
+        failure = None # the first error of submit, raised once every reply is read
+        timed = replies is not None
+        started = _now() if timed else None
+        while remaining:
+            lines = transport.recv_lines(remaining, decode, sizes)
+            remaining -= len(lines)
+            self._knuckleball._pending_replies -= len(lines)
+            if timed:
+                receive_seconds = (_now() - started) / len(lines)
+            for data in lines:
+                expect = next(expects)
+                if timed:
+                    started = _now()
+                error = None
+                if expect is not None and hasattr(expect, 'submit'):
+                    self._results.append(None)
+                    try:
+                        futures.append((len(self._results) - 1, expect.submit(data)))
+                    except exception.KnuckleballException as e:
+                        self._results[-1] = error = e
+                    except Exception as e:
+                        failure = failure or e
+                        error = e
+                else:
+                    try:
+                        self._results.append(Knuckleball._parse(data, expect))
+                    except exception.KnuckleballException as e:
+                        self._results.append(e)
+                        error = e
+                if timed:
+                    now = _now()
+                    replies.append([receive_seconds, now - started, error])
+                    started = now
+        for position, future in futures:
+            try:
+                self._results[position] = future.result()
+            except exception.KnuckleballException as e:
+                self._results[position] = e
+                if timed:
+                    replies[position - first][2] = e
+        if failure is not None:
+            del self._results[first:] # the results of this batch would be mistaken for those of the next one
+            raise failure
 
     @staticmethod
-    def _parse_dictionary(data):
-        return dict(Knuckleball._parse_comma_separated_tuples(data[1:-1]))
+    def _after(hooks, commands, times, replies, sizes, error):
+        "Call the hooks with a CommandEvent for each command of a batch."
+        # The seconds to send a batch, and to receive each group of replies that arrive together, are shared evenly by
+        # their commands, which have no wait phase of their own.
+        send_seconds = (times[1] - times[0]) / len(commands) if len(times) > 1 else None
+        for index, command in enumerate(commands):
+            if index < len(replies):
+                receive_seconds, parse_seconds, reply_error = replies[index]
+                bytes_received = sizes[index]
+            else: # the error was raised before this reply was read
+                receive_seconds, parse_seconds, reply_error, bytes_received = None, None, error, 0
+            event = metrics.CommandEvent(command, send_seconds, None, receive_seconds, parse_seconds,
+                                         len(command.encode('utf8')) + 1, bytes_received, reply_error)
+            for hook in hooks:
+                hook.after(event)
+
+    def execute(self):
+        "Send the queued commands and return every result since the last call, with errors in place of results."
+        self.flush()
+        results, self._results = self._results, []
+        return results
@@ -21,25 +21,156 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import codecs
+import errno
+import mmap
+import select
 import socket
 import sys
+import tempfile
+import threading
+import time
 
-class TCPConnection:
-    def __init__(self, host, port, timeout_in_seconds=None):
-        "Set a TCP connection with the server or raise an error."
-        self._sock = None
-        self._buffer = ''
-        for addrinfo in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
-            try:
-                self._connect(timeout_in_seconds, *addrinfo)
-            except:
-                if self._sock is not None:
-                    self._sock.close()
-                    self._sock = None
-            if self._sock is not None:
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+_now = getattr(time, 'monotonic', time.time)
+
+# Seconds to wait for a connection attempt before starting the next one in parallel, as in RFC 8305.
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+class Resolver:
+    def __init__(self, ttl_in_seconds=60.0, max_entries=256):
+        "Cache the addresses of hosts for ttl_in_seconds, sharing them between connections."
+        self.ttl_in_seconds = ttl_in_seconds
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {} # (host, port) -> (addresses, expiration)
+
+    def resolve(self, host, port):
+        "Return the getaddrinfo results for a TCP connection with host and port, resolving them if not cached."
+        key = (host, port)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[1] > _now():
+            return entry[0]
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        with self._lock:
+            if len(self._entries) >= self._max_entries:
+                self._entries.clear()
+            self._entries[key] = (addresses, _now() + self.ttl_in_seconds)
+        return addresses
+
+    def forget(self, host, port):
+        "Forget the cached addresses of host and port, so that the next connection resolves them again."
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+    def clear(self):
+        "Forget every cached address."
+        with self._lock:
+            self._entries.clear()
+
+resolver = Resolver()
+
+def _interleave(addresses):
+    "Return addresses alternating between families, starting with the first one, as in RFC 8305."
+    families = {}
+    for address in addresses:
+        families.setdefault(address[0], []).append(address)
+    queues = sorted(families.values(), key=lambda queue: addresses.index(queue[0]))
+    interleaved = []
+    while queues:
+        interleaved.extend(queue.pop(0) for queue in queues)
+        queues = [queue for queue in queues if queue]
+    return interleaved
+
+def _set_buffer_sizes(sock, send_buffer_size, receive_buffer_size):
+    "Set the sizes of the kernel buffers of a socket, unless they are None."
+    if send_buffer_size is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer_size)
+    if receive_buffer_size is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+
+def _writable(socks, timeout_in_seconds):
+    "Return the sockets of socks that become writable within timeout_in_seconds, or at all if it is None."
+    # A selector rather than select.select, which fails on descriptors above FD_SETSIZE in busy processes, except in
+    # Python 2, which has no selectors.
+    if selectors is None:
+        return select.select([], socks, [], timeout_in_seconds)[1]
+    selector = selectors.DefaultSelector()
+    try:
+        for sock in socks:
+            selector.register(sock, selectors.EVENT_WRITE)
+        return [key.fileobj for key, _ in selector.select(timeout_in_seconds)]
+    finally:
+        selector.close()
+
+def connect(addresses, timeout_in_seconds=None, delay=CONNECTION_ATTEMPT_DELAY, send_buffer_size=None,
+            receive_buffer_size=None):
+    "Connect to the first of addresses to answer, starting an attempt every delay seconds, and return the socket."
+    deadline = None if timeout_in_seconds is None else _now() + timeout_in_seconds
+    queue = _interleave(list(addresses))
+    attempts = [] # sockets still connecting
+    next_attempt = _now()
+    try:
+        while queue or attempts:
+            now = _now()
+            if deadline is not None and now >= deadline:
                 break
-        if self._sock is None:
-            raise socket.error('unable to connect.')
+            if queue and (not attempts or now >= next_attempt):
+                family, socktype, proto, _, sockaddr = queue.pop(0)
+                next_attempt = now + delay
+                try:
+                    sock = socket.socket(family, socktype, proto)
+                except socket.error:
+                    continue
+                _set_buffer_sizes(sock, send_buffer_size, receive_buffer_size)
+                sock.setblocking(0)
+                result = sock.connect_ex(sockaddr)
+                if result == 0:
+                    return sock
+                if result in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                    attempts.append(sock)
+                else:
+                    sock.close()
+                continue
+            timeouts = [deadline - now] if deadline is not None else []
+            if queue:
+                timeouts.append(next_attempt - now)
+            for sock in _writable(attempts, max(0, min(timeouts)) if timeouts else None):
+                attempts.remove(sock)
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    return sock
+                sock.close()
+                next_attempt = now # a failed attempt starts the next one right away
+    finally:
+        for sock in attempts:
+            sock.close()
+    raise socket.error('unable to connect.')
+
+class Connection:
+    def __init__(self, read_size=65536, spill_threshold=None):
+        "Buffer what is received from the socket that a subclass connects."
+        # Lines longer than spill_threshold bytes are received into a temporary file instead of memory.
+        if spill_threshold is not None and spill_threshold < 1:
+            raise ValueError('spill_threshold must be positive.')
+        self._sock = None
+        self._read_size = read_size
+        self._spill_threshold = spill_threshold
+        # Received data is kept in _buffer[_start:_end], and _buffer[_start:_scanned] has no '\n'.
+        self._buffer = bytearray(read_size)
+        self._start = 0
+        self._scanned = 0
+        self._end = 0
+        self._line_size = 0 # bytes of the last line returned, with its '\n'
 
     def __del__(self):
         "Close the socket, if it exists."
@@ -48,12 +179,26 @@ class TCPConnection:
         except:
             pass
 
-    def _connect(self, timeout_in_seconds, family, socktype, proto, canonname, sockaddr):
-        "Try to connect to the server using the specified parameters."
-        self._sock = socket.socket(family, socktype, proto)
-        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        self._sock.settimeout(timeout_in_seconds);
-        self._sock.connect(sockaddr)
+    def close(self):
+        "Close the socket."
+        self._sock.close()
+
+    def is_idle(self):
+        "Return whether the socket is still open and there is no received data waiting to be read."
+        if self._end > self._start:
+            return False
+        timeout = self._sock.gettimeout()
+        try:
+            self._sock.setblocking(0)
+            self._sock.recv(1, socket.MSG_PEEK)
+            return False # either the server closed the connection or it sent data nobody asked for
+        except socket.error as e:
+            return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+        finally:
+            try:
+                self._sock.settimeout(timeout)
+            except socket.error:
+                pass
 
     def send(self, data):
         "Send all data to the socket."
@@ -62,13 +207,219 @@ class TCPConnection:
         else:
             self._sock.sendall(bytes(data))
 
-    def recv(self):
-        "Receive data from the socket and return it until '\n'."
-        while self._buffer.find('\n') < 0:
-            received = self._sock.recv(4096)
-            if len(received) == 0:
-                raise socket.error('connection closed by foreign host.')
-            self._buffer += received.decode('utf8')
-        data = self._buffer[:self._buffer.find('\n')]
-        self._buffer = self._buffer[len(data) + 1:]
+    def _fill(self):
+        "Receive up to read_size bytes from the socket into the buffer or raise an error."
+        if len(self._buffer) - self._end < self._read_size:
+            unread = self._end - self._start
+            if self._start > 0:
+                self._buffer[:unread] = self._buffer[self._start:self._end]
+                self._scanned -= self._start
+                self._start, self._end = 0, unread
+            if len(self._buffer) - self._end < self._read_size:
+                self._buffer.extend(bytearray(max(len(self._buffer), self._read_size)))
+        received = self._sock.recv_into(memoryview(self._buffer)[self._end:], self._read_size)
+        if received == 0:
+            raise socket.error('connection closed by foreign host.')
+        self._end += received
+
+    def _next_line(self, decode=None):
+        "Return the next line in the buffer without its '\n', or None if it is not complete yet."
+        # The line is decoded by decode, such as memoryview.tobytes to keep it undecoded, or as UTF-8 if it is None.
+        index = self._buffer.find(b'\n', self._scanned, self._end)
+        if index < 0:
+            self._scanned = self._end
+            return None
+        data = (decode or _decode)(memoryview(self._buffer)[self._start:index])
+        self._line_size = index + 1 - self._start
+        self._consume(index + 1)
+        return data
+
+    def _consume(self, end):
+        "Drop the buffered data before end, shrinking the buffer once it is empty."
+        self._start = self._scanned = end
+        if self._start == self._end:
+            self._start = self._scanned = self._end = 0
+            if len(self._buffer) > 4 * self._read_size:
+                self._buffer = bytearray(self._read_size)
+
+    def wait(self):
+        "Block until there is received data in the buffer or raise an error."
+        if self._end == self._start:
+            self._fill()
+
+    def recv(self, decode=None):
+        "Receive data from the socket and return it until '\n', or a Spill if it is longer than spill_threshold."
+        data = self._next_line(decode)
+        while data is None:
+            if self._spill_threshold is not None and self._end - self._start >= self._spill_threshold:
+                return self._spill()
+            self._fill()
+            data = self._next_line(decode)
         return data
+
+    def recv_bytes(self):
+        "Receive data from the socket and return it until '\n' as undecoded bytes, or a Spill as recv does."
+        return self.recv(memoryview.tobytes)
+
+    def _spill(self):
+        "Receive the rest of the current line into a temporary file and return it as a Spill."
+        with tempfile.TemporaryFile() as f:
+            size = 0
+            index = self._buffer.find(b'\n', self._scanned, self._end)
+            while index < 0:
+                f.write(memoryview(self._buffer)[self._start:self._end])
+                size += self._end - self._start
+                self._consume(self._end)
+                self._fill()
+                index = self._buffer.find(b'\n', self._start, self._end)
+            f.write(memoryview(self._buffer)[self._start:index])
+            self._line_size = size + index + 1 - self._start
+            self._consume(index + 1)
+            f.flush()
+            return Spill(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def recv_chunks(self):
+        "Receive data from the socket and yield it in pieces as it arrives, until '\n'."
+        # The decoder is given bytes, as the incremental decoders of Python 2 cannot take a memoryview.
+        decoder = codecs.getincrementaldecoder('utf8')()
+        self._line_size = 0
+        while True:
+            index = self._buffer.find(b'\n', self._start, self._end)
+            if index >= 0:
+                data = decoder.decode(memoryview(self._buffer)[self._start:index].tobytes(), True)
+                self._line_size += index + 1 - self._start
+                self._consume(index + 1)
+                if data:
+                    yield data
+                return
+            data = decoder.decode(memoryview(self._buffer)[self._start:self._end].tobytes())
+            self._line_size += self._end - self._start
+            self._consume(self._end)
+            if data:
+                yield data
+            self._fill()
+
+    def recv_lines(self, max_lines=None, decode=None, sizes=None):
+        "Receive data from the socket and return the complete lines in it, up to max_lines and at least one."
+        # The size in bytes of each line, with its '\n', is appended to sizes if it is a list.
+        lines = [self.recv(decode)]
+        if sizes is not None:
+            sizes.append(self._line_size)
+        while max_lines is None or len(lines) < max_lines:
+            data = self._next_line(decode)
+            if data is None:
+                break
+            lines.append(data)
+            if sizes is not None:
+                sizes.append(self._line_size)
+        return lines
+
+class TCPConnection(Connection):
+    def __init__(self, host, port, timeout_in_seconds=None, read_size=65536, spill_threshold=None,
+                 connect_timeout_in_seconds=None, send_buffer_size=None, receive_buffer_size=None):
+        "Set a TCP connection with the server or raise an error."
+        # Connecting takes up to connect_timeout_in_seconds, or timeout_in_seconds if it is None, which bounds every
+        # read and write.
+        Connection.__init__(self, read_size, spill_threshold)
+        if connect_timeout_in_seconds is None:
+            connect_timeout_in_seconds = timeout_in_seconds
+        try:
+            self._sock = connect(resolver.resolve(host, port), connect_timeout_in_seconds,
+                                 send_buffer_size=send_buffer_size, receive_buffer_size=receive_buffer_size)
+        except socket.error:
+            # None of the cached addresses answered, so the host may have moved before their TTL expired.
+            resolver.forget(host, port)
+            raise
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock.settimeout(timeout_in_seconds)
+
+class UnixConnection(Connection):
+    def __init__(self, path, timeout_in_seconds=None, read_size=65536, spill_threshold=None,
+                 connect_timeout_in_seconds=None, send_buffer_size=None, receive_buffer_size=None):
+        "Set a connection with the server listening on a Unix domain socket or raise an error."
+        Connection.__init__(self, read_size, spill_threshold)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            _set_buffer_sizes(sock, send_buffer_size, receive_buffer_size)
+            sock.settimeout(timeout_in_seconds if connect_timeout_in_seconds is None else connect_timeout_in_seconds)
+            sock.connect(path)
+        except socket.error:
+            sock.close()
+            raise socket.error('unable to connect.')
+        sock.settimeout(timeout_in_seconds)
+        self._sock = sock
+
+def _tcp(url, **options):
+    "Open the TCPConnection of a URL such as knuckleball://localhost:8001."
+    if not url.hostname or url.port is None:
+        raise ValueError('host and port expected in %s.' % url.geturl())
+    return TCPConnection(url.hostname, url.port, **options)
+
+def _unix(url, **options):
+    "Open the UnixConnection of a URL such as knuckleball+unix:///run/kb.sock."
+    if not url.path:
+        raise ValueError('path expected in %s.' % url.geturl())
+    return UnixConnection(url.path, **options)
+
+# URL scheme -> function(url, **options) that opens a connection, where url is the result of urlsplit and options are
+# the keyword arguments of TCPConnection after port.
+TRANSPORTS = {
+    'knuckleball': _tcp,
+    'knuckleball+tcp': _tcp,
+    'knuckleball+unix': _unix,
+}
+
+def address(host, port=None):
+    "Return the URL of host and port, or host if port is None, as open_connection accepts it."
+    if port is None:
+        return host
+    return 'knuckleball://%s:%d' % ('[%s]' % host if ':' in host else host, port)
+
+def open_connection(host, port=None, **options):
+    "Open a TCPConnection with host and port or, if port is None, the connection of a URL in host."
+    if port is not None:
+        return TCPConnection(host, port, **options)
+    url = urlsplit(host)
+    transport = TRANSPORTS.get(url.scheme)
+    if transport is None:
+        raise ValueError('unsupported URL %s.' % host)
+    return transport(url, **options)
+
+class Spill:
+    def __init__(self, buffer):
+        "Hold a line received into an mmap of a deleted temporary file, which is freed once the mmap is closed."
+        self.buffer = buffer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def close(self):
+        "Close the mmap, freeing the file."
+        self.buffer.close()
+
+    def chunks(self, size=1 << 20):
+        "Yield the text of the line in pieces of up to size bytes."
+        decoder = codecs.getincrementaldecoder('utf8')()
+        for start in range(0, len(self.buffer), size):
+            data = decoder.decode(self.buffer[start:start + size], start + size >= len(self.buffer))
+            if data:
+                yield data
+
+    def decode(self):
+        "Return the whole text of the line."
+        return self.buffer[:].decode('utf8')
+
+if sys.version_info >= (3, 0):
+    def _decode(view):
+        "Decode UTF-8 bytes from a memoryview."
+        return str(view, 'utf8')
+else:
+    def _decode(view):
+        "Decode UTF-8 bytes from a memoryview."
+        return view.tobytes().decode('utf8')
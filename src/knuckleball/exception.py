@@ -23,3 +23,9 @@
 
 class KnuckleballException(Exception):
     pass
+
+class PoolTimeoutException(KnuckleballException):
+    pass
+
+class TypeMismatchException(KnuckleballException):
+    pass
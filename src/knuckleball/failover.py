@@ -0,0 +1,210 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import random
+import socket
+import threading
+import time
+
+from knuckleball import client
+from knuckleball import connection
+from knuckleball import exception
+
+_now = getattr(time, 'monotonic', time.time)
+
+class _Endpoint:
+    def __init__(self, host, port):
+        "Keep the connection with a server, while it is up, and a moving average of its round trips."
+        self.host = host
+        self.port = port
+        self.knuckleball = None
+        self.rtt_in_seconds = None
+        self.measured_at = None # when the last round trip was measured, or a probe was started
+        self.in_flight = 0 # commands that chose the endpoint and have not finished
+        self.failures = 0
+        self.reconnects = 0
+        self.reconnecting = False
+        self.lock = threading.Lock() # held while a command uses the connection
+
+def _expected_seconds(endpoint):
+    "Return the seconds an endpoint is expected to take to answer one more command."
+    # A first round trip still in flight counts as none, as before it was sent.
+    return (endpoint.rtt_in_seconds or 0.0) * (endpoint.in_flight + 1)
+
+class FailoverKnuckleball:
+    def __init__(self, endpoints, timeout_in_seconds=None, password=None, smoothing=0.2, backoff_in_seconds=0.05,
+                 max_backoff_in_seconds=5.0, max_retries=2, hooks=(), probe_interval_in_seconds=5.0):
+        "Connect to every (host, port) in endpoints and execute each command in the one expected to answer first."
+        # Round trips are averaged with weight smoothing for the last one. An endpoint not measured for
+        # probe_interval_in_seconds gets the next command, so that one that was slow once is measured again. Endpoints
+        # that fail are reconnected in the background after random delays of up to backoff_in_seconds, doubled on
+        # every failed attempt.
+        self._timeout_in_seconds = timeout_in_seconds
+        self._password = password
+        self._smoothing = smoothing
+        self._backoff_in_seconds = backoff_in_seconds
+        self._max_backoff_in_seconds = max_backoff_in_seconds
+        self._max_retries = max_retries
+        self._hooks = tuple(hooks)
+        self._probe_interval_in_seconds = probe_interval_in_seconds
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._endpoints = [_Endpoint(host, port) for host, port in endpoints]
+        for endpoint in self._endpoints:
+            try:
+                endpoint.knuckleball = self._connect(endpoint)
+            except socket.error:
+                self._reconnect(endpoint)
+        if not any(endpoint.knuckleball for endpoint in self._endpoints):
+            self.close()
+            raise socket.error('unable to connect.')
+
+    def _connect(self, endpoint):
+        "Open and authenticate a connection with an endpoint."
+        return client.Knuckleball(endpoint.host, endpoint.port, self._timeout_in_seconds, self._password,
+                                  hooks=self._hooks)
+
+    def _choose(self):
+        "Return the connected endpoint expected to answer first, counting it in flight, or raise an error."
+        # Endpoints not measured yet, or not for probe_interval_in_seconds, are tried first. The others are expected to
+        # answer after a round trip for each command in flight there, so concurrent commands spread over the
+        # endpoints that are almost as fast instead of waiting for the connection of the fastest one.
+        with self._lock:
+            connected = [endpoint for endpoint in self._endpoints if endpoint.knuckleball is not None]
+            if not connected:
+                raise exception.KnuckleballException('no endpoint available.')
+            now = _now()
+            for endpoint in connected:
+                if endpoint.measured_at is None or now - endpoint.measured_at >= self._probe_interval_in_seconds:
+                    endpoint.measured_at = now # probed by this command only
+                    break
+            else:
+                endpoint = min(connected, key=_expected_seconds)
+            endpoint.in_flight += 1
+            return endpoint
+
+    def execute(self, command, expect=None, idempotent=False):
+        "Execute a command and return the result, of the expected type, retrying it elsewhere if idempotent is set."
+        # Threads may share this client: a command holds the lock of its endpoint from taking its connection until it
+        # is measured or dropped, so that commands on the same connection never interleave.
+        retries = 0
+        while True:
+            endpoint = self._choose()
+            try:
+                with endpoint.lock:
+                    knuckleball = endpoint.knuckleball
+                    if knuckleball is None:
+                        continue # dropped by another thread in the meantime
+                    started = _now()
+                    try:
+                        result = knuckleball.execute(command, expect)
+                    except socket.error:
+                        self._fail(endpoint, knuckleball)
+                        if not idempotent or retries >= self._max_retries:
+                            raise
+                        retries += 1
+                        continue
+                    except exception.KnuckleballException:
+                        self._measure(endpoint, _now() - started)
+                        raise
+                    self._measure(endpoint, _now() - started)
+                    return result
+            finally:
+                with self._lock:
+                    endpoint.in_flight -= 1
+
+    def _measure(self, endpoint, seconds):
+        "Add a round trip to the moving average of an endpoint."
+        with self._lock:
+            if endpoint.rtt_in_seconds is None:
+                endpoint.rtt_in_seconds = seconds
+            else:
+                endpoint.rtt_in_seconds += self._smoothing * (seconds - endpoint.rtt_in_seconds)
+            endpoint.measured_at = _now()
+
+    def _fail(self, endpoint, knuckleball):
+        "Drop the connection with an endpoint that failed and reconnect to it in the background."
+        with self._lock:
+            if endpoint.knuckleball is not knuckleball:
+                return
+            endpoint.knuckleball = None
+            endpoint.failures += 1
+        try:
+            knuckleball.close()
+        except socket.error:
+            pass
+        self._reconnect(endpoint)
+
+    def _reconnect(self, endpoint):
+        "Start a thread that reconnects to an endpoint, unless one is running."
+        with self._lock:
+            if endpoint.reconnecting or self._closed.is_set():
+                return
+            endpoint.reconnecting = True
+        thread = threading.Thread(target=self._reconnect_loop, args=(endpoint,))
+        thread.daemon = True
+        thread.start()
+
+    def _reconnect_loop(self, endpoint):
+        "Try to reconnect to an endpoint after jittered, exponentially growing delays, until it works or we close."
+        attempt = 0
+        while not self._closed.wait(random.uniform(0, min(self._max_backoff_in_seconds,
+                                                             self._backoff_in_seconds * 2 ** attempt))):
+            try:
+                knuckleball = self._connect(endpoint)
+            except Exception:
+                attempt += 1
+                continue
+            with self._lock:
+                if self._closed.is_set():
+                    knuckleball.close()
+                else:
+                    endpoint.knuckleball = knuckleball
+                    endpoint.rtt_in_seconds = None
+                    endpoint.measured_at = None
+                    endpoint.reconnects += 1
+                endpoint.reconnecting = False
+            return
+        with self._lock:
+            endpoint.reconnecting = False
+
+    def close(self):
+        "Stop reconnecting and close the connections with every endpoint."
+        with self._lock:
+            self._closed.set()
+            knuckleballs = [endpoint.knuckleball for endpoint in self._endpoints if endpoint.knuckleball is not None]
+            for endpoint in self._endpoints:
+                endpoint.knuckleball = None
+        for knuckleball in knuckleballs:
+            knuckleball.close()
+
+    def stats(self):
+        "Return, for each endpoint, whether it is connected, its average round trip, failures and reconnections."
+        with self._lock:
+            return [{
+                'endpoint': connection.address(endpoint.host, endpoint.port),
+                'connected': endpoint.knuckleball is not None,
+                'rtt_in_seconds': endpoint.rtt_in_seconds,
+                'failures': endpoint.failures,
+                'reconnects': endpoint.reconnects,
+            } for endpoint in self._endpoints]
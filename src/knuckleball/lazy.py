@@ -0,0 +1,163 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+try:
+    from collections import abc
+except ImportError:
+    import collections as abc
+
+def _decode(token):
+    "Return the value of an element of a reply, from its UTF-8 bytes."
+    first = token[:1]
+    if first == b'"':
+        return token.decode('utf8')[1:-1].replace('\\"', '"')
+    if first == b"'":
+        return token.decode('utf8')[1]
+    if first.isdigit() or first in (b'+', b'-'):
+        return float(token) if b'.' in token else int(token)
+    if token == b'true':
+        return True
+    if token == b'false':
+        return False
+    return token.decode('utf8')
+
+class _Closeable(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        "Free the buffer of the reply, such as the mmap of a spilled one, after which no element can be read."
+        close = getattr(self._buffer, 'close', None)
+        if close is not None:
+            close()
+
+class LazyVector(_Closeable, abc.Sequence):
+    __slots__ = ('_buffer', '_offsets')
+
+    def __init__(self, buffer, offsets):
+        "Decode elements of a reply only when they are read. Element i is buffer[offsets[i]:offsets[i + 1] - 1]."
+        self._buffer = buffer
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def _element(self, index):
+        return _decode(self._buffer[self._offsets[index]:self._offsets[index + 1] - 1])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._element(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('index out of range.')
+        return self._element(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._element(index)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, LazyVector)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<LazyVector of %d elements>' % len(self)
+
+class LazySet(_Closeable, abc.Set):
+    __slots__ = ('_vector', '_members')
+
+    def __init__(self, buffer, offsets):
+        "Decode elements of a reply only when they are read, and all of them once membership is tested."
+        self._vector = LazyVector(buffer, offsets)
+        self._members = None
+
+    def close(self):
+        "Free the buffer of the reply, such as the mmap of a spilled one, after which no element can be read."
+        self._vector.close()
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        return set(iterable)
+
+    def __len__(self):
+        return len(self._vector)
+
+    def __iter__(self):
+        return iter(self._vector)
+
+    def __contains__(self, value):
+        if self._members is None:
+            self._members = frozenset(self._vector)
+        return value in self._members
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<LazySet of %d elements>' % len(self)
+
+class LazyDictionary(_Closeable, abc.Mapping):
+    __slots__ = ('_buffer', '_offsets', '_index')
+
+    def __init__(self, buffer, offsets):
+        "Decode keys and values of a reply only when they are read, and all keys once a key is looked up."
+        # Pair i has its key in buffer[offsets[3 * i]:offsets[3 * i + 1]] and its value up to offsets[3 * i + 2].
+        self._buffer = buffer
+        self._offsets = offsets
+        self._index = None
+
+    def __len__(self):
+        return len(self._offsets) // 3
+
+    def _key(self, index):
+        return _decode(self._buffer[self._offsets[3 * index]:self._offsets[3 * index + 1]])
+
+    def _value(self, index):
+        return _decode(self._buffer[self._offsets[3 * index + 1] + 1:self._offsets[3 * index + 2]])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._key(index)
+
+    def __getitem__(self, key):
+        if self._index is None:
+            self._index = dict((k, index) for index, k in enumerate(self))
+        return self._value(self._index[key])
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<LazyDictionary of %d pairs>' % len(self)
@@ -0,0 +1,168 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import sys
+import threading
+import types
+
+from knuckleball import parser
+
+_IMMUTABLE = (type(None), bool, int, float, str, tuple, frozenset, types.MappingProxyType)
+_MUTABLE = object()
+
+class InternTable:
+    def __init__(self, max_entries=65536):
+        "Keep one copy of each parsed string, forgetting them all once there are max_entries."
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._strings = {}
+        self._lookups = 0
+        self._hits = 0
+        self._bytes_saved = 0
+
+    def intern(self, value):
+        "Return the kept copy of a string, keeping it if there is none."
+        with self._lock:
+            return self._intern(value)
+
+    def _intern(self, value):
+        self._lookups += 1
+        kept = self._strings.get(value)
+        if kept is not None:
+            self._hits += 1
+            self._bytes_saved += sys.getsizeof(value)
+            return kept
+        if len(self._strings) >= self._max_entries:
+            self._strings.clear()
+        self._strings[value] = value
+        return value
+
+    def intern_value(self, value):
+        "Return a parsed value with its strings, and those of its elements, replaced by their kept copies."
+        with self._lock:
+            intern = self._intern
+            if isinstance(value, str):
+                return intern(value)
+            if isinstance(value, list):
+                return [intern(v) if type(v) is str else v for v in value]
+            if isinstance(value, set):
+                return set(intern(v) if type(v) is str else v for v in value)
+            if isinstance(value, dict):
+                return dict((intern(k) if type(k) is str else k, intern(v) if type(v) is str else v)
+                            for k, v in value.items())
+            return value
+
+    def parse(self, data):
+        "Parse a response as the parser does, interning its strings, so the table can be passed as expect."
+        return self.intern_value(parser.parse(data))
+
+    def stats(self):
+        "Return the number of kept strings, lookups, hits, the hit rate and the bytes of duplicates not kept."
+        with self._lock:
+            return {
+                'entries': len(self._strings),
+                'lookups': self._lookups,
+                'hits': self._hits,
+                'hit_rate': float(self._hits) / self._lookups if self._lookups else 0.0,
+                'bytes_saved': self._bytes_saved,
+            }
+
+def freeze(value):
+    "Return an immutable version of a parsed value, or _MUTABLE if there is none."
+    if isinstance(value, list):
+        return tuple(value)
+    if isinstance(value, set):
+        return frozenset(value)
+    if isinstance(value, dict):
+        return types.MappingProxyType(value)
+    if isinstance(value, _IMMUTABLE):
+        return value
+    return _MUTABLE
+
+class MemoParser:
+    def __init__(self, max_replies=256, max_reply_size=1 << 16, expect=None, intern_table=None):
+        "Parse responses as the expected type, returning the same immutable result for identical responses."
+        # Up to max_replies responses of up to max_reply_size characters are kept along with their results, so that
+        # a response is only taken as seen when it is equal, not merely of equal hash. Longer responses are parsed
+        # every time. Strings are interned by intern_table, if any.
+        self.name = 'Memo' if expect is None else 'Memo<%s>' % expect.name
+        self._max_replies = max_replies
+        self._max_reply_size = max_reply_size
+        self._parse = parser.parse if expect is None else expect.parse
+        self._intern_table = intern_table
+        self._lock = threading.Lock()
+        self._results = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._characters_saved = 0
+
+    def __repr__(self):
+        return self.name
+
+    def parse(self, data):
+        "Return the immutable result of a response, or the result itself if it has none, parsing it only if needed."
+        if len(data) > self._max_reply_size:
+            return self._freeze(self._parse(data))[0]
+        with self._lock:
+            kept = self._results.get(data)
+            if kept is not None:
+                self._results.move_to_end(data)
+                self._hits += 1
+                self._characters_saved += len(data)
+                return kept[0]
+            self._misses += 1
+        result, frozen = self._freeze(self._parse(data))
+        if frozen:
+            with self._lock:
+                self._results[data] = (result,)
+                if len(self._results) > self._max_replies:
+                    self._results.popitem(last=False)
+        return result
+
+    def _freeze(self, value):
+        "Return the immutable version of a parsed value, with its strings interned, and whether there is one."
+        if self._intern_table is not None:
+            value = self._intern_table.intern_value(value)
+        frozen = freeze(value)
+        return (value, False) if frozen is _MUTABLE else (frozen, True)
+
+    def clear(self):
+        "Forget every kept result."
+        with self._lock:
+            self._results.clear()
+
+    def stats(self):
+        "Return the number of kept results, hits, misses, the hit rate and the characters not parsed again."
+        with self._lock:
+            lookups = self._hits + self._misses
+            stats = {
+                'replies': len(self._results),
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': float(self._hits) / lookups if lookups else 0.0,
+                'characters_saved': self._characters_saved,
+            }
+        if self._intern_table is not None:
+            stats['strings'] = self._intern_table.stats()
+        return stats
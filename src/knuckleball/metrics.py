@@ -0,0 +1,165 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import bisect
+import collections
+import threading
+
+from knuckleball import cache
+
+# Upper bounds of the buckets of the histograms of seconds and of bytes.
+SECONDS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+BYTES_BUCKETS = tuple(4 ** exponent for exponent in range(3, 14))
+
+PHASES = ('send', 'wait', 'receive', 'parse')
+
+# What a hook learns about an executed command. The seconds of a phase that was not reached are None, and error is the
+# exception raised, if any.
+CommandEvent = collections.namedtuple('CommandEvent', ['command', 'send_seconds', 'wait_seconds', 'receive_seconds',
+                                                       'parse_seconds', 'bytes_sent', 'bytes_received', 'error'])
+
+def verb(command):
+    "Return the message of a command, such as 'add:' for 'players add: 42;', or '' if there is none."
+    message = cache.split(cache.normalize(command))[1]
+    if not message:
+        return ''
+    colon = message.find(':')
+    return message if colon < 0 else message[:colon + 1]
+
+class Hook:
+    def before(self, command):
+        "Called before a command is sent."
+
+    def after(self, event):
+        "Called with the CommandEvent of a command after its result is parsed or an error is raised."
+
+class Histogram:
+    def __init__(self, buckets):
+        "Count observed values in buckets with the given upper bounds, plus one for greater values."
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class _VerbStats:
+    def __init__(self):
+        self.commands = 0
+        self.errors = collections.Counter() # exception class name -> count
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.seconds = dict((phase, Histogram(SECONDS_BUCKETS)) for phase in PHASES + ('total',))
+        self.response_bytes = Histogram(BYTES_BUCKETS)
+
+def _label(value):
+    "Escape a label value of the Prometheus text format."
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _histogram_lines(name, labels, histogram):
+    "Return the lines of a histogram in the Prometheus text format."
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+        cumulative += count
+        lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound if bound == '+Inf' else repr(bound), cumulative))
+    lines.append('%s_sum{%s} %r' % (name, labels, histogram.sum))
+    lines.append('%s_count{%s} %d' % (name, labels, histogram.count))
+    return lines
+
+class MetricsCollector(Hook):
+    def __init__(self):
+        "Collect, per verb, histograms of the seconds of each phase of commands, sizes of responses and errors."
+        self._lock = threading.Lock()
+        self._verbs = {}
+
+    def after(self, event):
+        name = verb(event.command)
+        phases = (event.send_seconds, event.wait_seconds, event.receive_seconds, event.parse_seconds)
+        with self._lock:
+            stats = self._verbs.get(name)
+            if stats is None:
+                stats = self._verbs[name] = _VerbStats()
+            stats.commands += 1
+            stats.bytes_sent += event.bytes_sent
+            stats.bytes_received += event.bytes_received
+            for phase, seconds in zip(PHASES, phases):
+                if seconds is not None:
+                    stats.seconds[phase].observe(seconds)
+            stats.seconds['total'].observe(sum(seconds for seconds in phases if seconds is not None))
+            if event.receive_seconds is not None:
+                stats.response_bytes.observe(event.bytes_received)
+            if event.error is not None:
+                stats.errors[type(event.error).__name__] += 1
+
+    def reset(self):
+        "Forget everything collected."
+        with self._lock:
+            self._verbs = {}
+
+    def stats(self):
+        "Return a dictionary from each verb to its counts, bytes and the count and sum of seconds of each phase."
+        with self._lock:
+            return dict((name, {
+                'commands': stats.commands,
+                'errors': dict(stats.errors),
+                'bytes_sent': stats.bytes_sent,
+                'bytes_received': stats.bytes_received,
+                'seconds': dict((phase, {'count': histogram.count, 'sum': histogram.sum})
+                                for phase, histogram in stats.seconds.items()),
+            }) for name, stats in self._verbs.items())
+
+    def export(self, prefix='knuckleball'):
+        "Return the collected metrics in the Prometheus text exposition format."
+        with self._lock:
+            verbs = sorted(self._verbs.items())
+            lines = ['# HELP %s_commands_total Commands executed.' % prefix,
+                     '# TYPE %s_commands_total counter' % prefix]
+            lines.extend('%s_commands_total{verb="%s"} %d' % (prefix, _label(name), stats.commands)
+                         for name, stats in verbs)
+            lines.extend(['# HELP %s_errors_total Commands that raised an error.' % prefix,
+                          '# TYPE %s_errors_total counter' % prefix])
+            lines.extend('%s_errors_total{verb="%s",type="%s"} %d' % (prefix, _label(name), _label(kind), count)
+                         for name, stats in verbs for kind, count in sorted(stats.errors.items()))
+            for direction in ('sent', 'received'):
+                lines.extend(['# HELP %s_%s_bytes_total Bytes %s.' % (prefix, direction, direction),
+                              '# TYPE %s_%s_bytes_total counter' % (prefix, direction)])
+                lines.extend('%s_%s_bytes_total{verb="%s"} %d' % (prefix, direction, _label(name),
+                                                                  getattr(stats, 'bytes_' + direction))
+                             for name, stats in verbs)
+            lines.extend(['# HELP %s_command_seconds Seconds spent in each phase of commands.' % prefix,
+                          '# TYPE %s_command_seconds histogram' % prefix])
+            for name, stats in verbs:
+                for phase in PHASES + ('total',):
+                    lines.extend(_histogram_lines('%s_command_seconds' % prefix,
+                                                  'verb="%s",phase="%s"' % (_label(name), phase), stats.seconds[phase]))
+            lines.extend(['# HELP %s_response_bytes Sizes of responses.' % prefix,
+                          '# TYPE %s_response_bytes histogram' % prefix])
+            for name, stats in verbs:
+                lines.extend(_histogram_lines('%s_response_bytes' % prefix, 'verb="%s"' % _label(name),
+                                              stats.response_bytes))
+        return '\n'.join(lines) + '\n'
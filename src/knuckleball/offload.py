@@ -0,0 +1,138 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import concurrent.futures
+import threading
+
+from knuckleball import connection
+from knuckleball import parser
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+def _parse_shared(name, size, expect):
+    "Parse a response of size bytes in the shared memory block called name, in a worker process."
+    block = shared_memory.SharedMemory(name)
+    try:
+        view = block.buf[:size]
+        try:
+            data = str(view, 'utf8')
+        finally:
+            view.release()
+    finally:
+        block.close()
+    return parser.parse(data) if expect is None else expect.parse(data)
+
+class ProcessParser:
+    def __init__(self, threshold=1 << 22, max_workers=None, expect=None):
+        "Parse responses of at least threshold bytes, in UTF-8, as the expected type in a pool of worker processes."
+        # Smaller responses are parsed in the calling thread. The others are copied into shared memory, which the
+        # workers read instead of receiving them pickled.
+        if shared_memory is None:
+            raise ImportError('Python 3.8 or later is required to parse in other processes.')
+        self.name = 'Process' if expect is None else 'Process<%s>' % expect.name
+        self._threshold = threshold
+        self._max_workers = max_workers
+        self._expect = expect
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def __repr__(self):
+        return self.name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _parse(self, data):
+        return parser.parse(data) if self._expect is None else self._expect.parse(data)
+
+    def submit(self, data):
+        "Return a Future of the result of a response, in text, UTF-8 bytes or a Spill, parsed in a worker if large."
+        if _size(data) < self._threshold:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(self._parse(_decode(data)))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                if isinstance(data, connection.Spill):
+                    data.close()
+            return future
+        # Bytes and Spills are copied into shared memory as received, only text is encoded first.
+        if isinstance(data, connection.Spill):
+            with data:
+                block, size = _share(data.buffer)
+        else:
+            block, size = _share(data if isinstance(data, bytes) else data.encode('utf8'))
+        try:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = concurrent.futures.ProcessPoolExecutor(self._max_workers)
+                future = self._executor.submit(_parse_shared, block.name, size, self._expect)
+        except:
+            _release(block)
+            raise
+        future.add_done_callback(lambda future: _release(block))
+        return future
+
+    def parse(self, data):
+        "Parse a response, blocking only the calling thread while a worker parses it, or raise an error."
+        return self.submit(data).result()
+
+    parse_spill = parse
+
+    def close(self):
+        "Stop the worker processes."
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+def _decode(data):
+    "Return the text of a response, as text, UTF-8 bytes or a connection.Spill."
+    if isinstance(data, connection.Spill):
+        return data.decode()
+    return data.decode('utf8') if isinstance(data, bytes) else data
+
+def _size(data):
+    "Return the size in UTF-8 bytes of a response, as text, UTF-8 bytes or a connection.Spill."
+    if isinstance(data, str) and not data.isascii():
+        return len(data.encode('utf8'))
+    return len(data)
+
+def _share(buffer):
+    "Copy a bytes-like buffer into a new shared memory block and return the block and the size of the buffer."
+    size = len(buffer)
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    block.buf[:size] = buffer
+    return block, size
+
+def _release(block):
+    "Free a shared memory block."
+    block.close()
+    block.unlink()
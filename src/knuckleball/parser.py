@@ -0,0 +1,259 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import re
+
+from knuckleball import exception
+
+# Every value that may appear inside a Vector, a Set or a tuple of a Dictionary. The groups are numbered so that the
+# parser dispatches on `match.lastindex` without probing the value again.
+_STRING, _CHARACTER, _FLOAT, _INTEGER, _VARIABLE = range(1, 6)
+_ELEMENT = re.compile(r'''
+    ("[^"\\]*(?:\\.[^"\\]*)*")                      # String, where '\"' is an escaped quote
+  | ('.')                                           # Character
+  | ([+-]?\d+\.\d+)                                 # Float
+  | ([+-]?\d+)                                      # Integer
+  | ([^\W\d_]\w*(?:::[^\W\d_]\w*)?)                 # Boolean, namespace or variable
+''', re.S | re.U | re.X)
+_STRING_VALUE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"\Z', re.S | re.U)
+_STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.S | re.U)
+_NUMBER_VALUE = re.compile(r'[+-]?\d+(\.\d+)?\Z', re.U)
+_ERRORS = ('SyntaxError:', 'RuntimeError:', 'AuthenticationError:')
+_CLOSING = {'[': ']', '{': '}', '(': ')'}
+
+def parse(data):
+    "Parse a response of the Knuckleball server in a single pass and return its value or raise an error."
+    if not data:
+        raise exception.KnuckleballException('invalid value.')
+    first, last = data[0], data[-1]
+    if first == '[' and last == ']':
+        return _parse_values(data, 1, len(data) - 1, [])
+    if first == '{' and last == '}':
+        return set(_parse_values(data, 1, len(data) - 1, []))
+    if first == '(' and last == ')':
+        return dict(_parse_tuples(data, 1, len(data) - 1))
+    if first == '"':
+        if _STRING_VALUE.match(data) is None:
+            raise exception.KnuckleballException('invalid value.')
+        return _decode_string(data)
+    if first == "'":
+        if len(data) != 3 or last != "'":
+            raise exception.KnuckleballException('invalid value.')
+        return data[1]
+    if data == 'null':
+        return None
+    if data == 'true':
+        return True
+    if data == 'false':
+        return False
+    match = _NUMBER_VALUE.match(data)
+    if match is not None:
+        return float(data) if match.group(1) else int(data)
+    if is_error(data):
+        raise exception.KnuckleballException(data)
+    raise exception.KnuckleballException('invalid value.')
+
+def is_error(data):
+    "Return whether a response of the Knuckleball server is an error."
+    return data.startswith(_ERRORS)
+
+def _decode_string(token):
+    "Return the value of a String token, unescaping its quotes."
+    return token[1:-1].replace('\\"', '"')
+
+def _decode_element(match):
+    "Return the value of an element matched by _ELEMENT."
+    index = match.lastindex
+    token = match.group(index)
+    if index == _STRING:
+        return _decode_string(token)
+    if index == _CHARACTER:
+        return token[1]
+    if index == _FLOAT:
+        return float(token)
+    if index == _INTEGER:
+        return int(token)
+    if token == 'true':
+        return True
+    if token == 'false':
+        return False
+    return token
+
+def _parse_values(data, pos, end, values):
+    "Append to values the comma separated values of data[pos:end] and return them or raise an error."
+    match_element = _ELEMENT.match
+    append = values.append
+    while pos < end:
+        match = match_element(data, pos, end)
+        if match is None:
+            raise exception.KnuckleballException('invalid value.')
+        append(_decode_element(match))
+        pos = match.end()
+        if pos < end:
+            if data[pos] != ',':
+                raise exception.KnuckleballException('invalid value.')
+            pos += 1
+    return values
+
+def _parse_tuples(data, pos, end):
+    "Return the comma separated (key, value) tuples of data[pos:end] or raise an error."
+    match_element = _ELEMENT.match
+    tuples = []
+    while pos < end:
+        if data[pos] != '(':
+            raise exception.KnuckleballException('invalid value.')
+        key = match_element(data, pos + 1, end)
+        if key is None or key.end() >= end or data[key.end()] != ',':
+            raise exception.KnuckleballException('invalid value.')
+        value = match_element(data, key.end() + 1, end)
+        if value is None:
+            raise exception.KnuckleballException('invalid value.')
+        pos = value.end()
+        if pos < end and data[pos] == ',':
+            pos += 1
+        if pos >= end or data[pos] != ')':
+            raise exception.KnuckleballException('invalid value.')
+        tuples.append((_decode_element(key), _decode_element(value)))
+        pos += 1
+        if pos < end:
+            if data[pos] != ',':
+                raise exception.KnuckleballException('invalid value.')
+            pos += 1
+    return tuples
+
+def iterparse(chunks):
+    "Parse a Vector, Set or Dictionary received in chunks, yielding its elements or (key, value) pairs as they arrive."
+    stream = _Stream(chunks)
+    opening = stream.peek()
+    if opening not in _CLOSING:
+        parse(stream.rest())
+        raise exception.KnuckleballException('not a Vector, a Set or a Dictionary.')
+    closing = _CLOSING[opening]
+    stream.pos += 1
+    if opening == '(':
+        while stream.peek() != ')':
+            stream.expect('(')
+            key = stream.element(',')
+            stream.pos += 1
+            value = stream.element(',)')
+            if stream.peek() == ',':
+                stream.pos += 1
+            stream.expect(')')
+            yield key, value
+            if stream.peek() == ',':
+                stream.pos += 1
+            elif stream.peek() != ')':
+                raise exception.KnuckleballException('invalid value.')
+    else:
+        separators = ',' + closing
+        while stream.peek() != closing:
+            yield stream.element(separators)
+            if stream.peek() == ',':
+                stream.pos += 1
+    stream.pos += 1
+    if stream.peek():
+        raise exception.KnuckleballException('invalid value.')
+
+class _Stream:
+    def __init__(self, chunks):
+        "Read text from an iterable of chunks, keeping only what was not parsed yet."
+        self._chunks = iter(chunks)
+        self.text = ''
+        self.pos = 0
+
+    def more(self):
+        "Append the next chunk to the text that was not parsed yet, or return False if there is none."
+        for chunk in self._chunks:
+            if chunk:
+                self.text = self.text[self.pos:] + chunk
+                self.pos = 0
+                return True
+        return False
+
+    def rest(self):
+        "Return the text that was not parsed yet followed by every chunk left."
+        self.text = ''.join([self.text[self.pos:]] + list(self._chunks))
+        self.pos = 0
+        return self.text
+
+    def peek(self):
+        "Return the next character, or '' at the end of the text."
+        while self.pos >= len(self.text):
+            if not self.more():
+                return ''
+        return self.text[self.pos]
+
+    def expect(self, character):
+        "Skip the next character or raise an error if it is not the expected one."
+        if self.peek() != character:
+            raise exception.KnuckleballException('invalid value.')
+        self.pos += 1
+
+    def element(self, separators):
+        "Parse and return the next element, which must be followed by one of separators, or raise an error."
+        while True:
+            match = _ELEMENT.match(self.text, self.pos)
+            if match is not None and match.end() < len(self.text):
+                if self.text[match.end()] in separators:
+                    self.pos = match.end()
+                    return _decode_element(match)
+                # More text could still extend a Float or a namespaced name, by at most two characters.
+                if match.end() + 2 < len(self.text):
+                    raise exception.KnuckleballException('invalid value.')
+            if not self._extend(separators):
+                raise exception.KnuckleballException('invalid value.')
+
+    def _extend(self, separators):
+        "Append chunks to the text not parsed yet until the element there may be complete, or return False if none."
+        # The chunks are only joined once one of them may end the element: for a String, one with its closing quote,
+        # and for other elements one with a separator. Each chunk is scanned once, so long elements take linear time.
+        pending = [self.text[self.pos:]]
+        quoted = closed = escaped = None
+        if pending[0]:
+            quoted = pending[0][0] == '"'
+            if quoted:
+                closed, escaped = _scan_string(pending[0], 1)
+        for chunk in self._chunks:
+            if not chunk:
+                continue
+            pending.append(chunk)
+            if quoted is None:
+                quoted = chunk[0] == '"'
+                if quoted:
+                    closed, escaped = _scan_string(chunk, 1)
+            elif quoted and not closed:
+                closed, escaped = _scan_string(chunk, 1 if escaped else 0)
+            if closed if quoted else any(separator in chunk for separator in separators):
+                break
+        if len(pending) == 1:
+            return False
+        self.text = ''.join(pending)
+        self.pos = 0
+        return True
+
+def _scan_string(text, pos):
+    "Scan the body of a String in text from pos and return whether it was closed and whether text ends escaping."
+    end = _STRING_BODY.match(text, pos).end()
+    if end < len(text) and text[end] == '"':
+        return True, False
+    return False, end < len(text) # stopped at a backslash ending the text
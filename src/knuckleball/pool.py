@@ -0,0 +1,186 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import contextlib
+import threading
+import time
+
+from knuckleball import client
+from knuckleball import exception
+
+_now = getattr(time, 'monotonic', time.time)
+
+class KnuckleballPool:
+    def __init__(self, host, port=None, timeout_in_seconds=None, password=None, min_size=0, max_size=10,
+                 health_check=None, hooks=(), connect_timeout_in_seconds=None, send_buffer_size=None,
+                 receive_buffer_size=None):
+        "Keep up to max_size authenticated connections, opening min_size now and running health_check on borrow."
+        self._host = host
+        self._port = port
+        self._timeout_in_seconds = timeout_in_seconds
+        self._password = password
+        self._max_size = max_size
+        self._health_check = health_check
+        self._hooks = tuple(hooks)
+        self._connect_timeout_in_seconds = connect_timeout_in_seconds
+        self._send_buffer_size = send_buffer_size
+        self._receive_buffer_size = receive_buffer_size
+        self._condition = threading.Condition()
+        self._idle = collections.deque()
+        self._closed = False
+        self._size = 0
+        self._in_use = 0
+        self._acquisitions = 0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._wait_seconds_total = 0.0
+        self._wait_seconds_max = 0.0
+        for _ in range(min_size):
+            self._idle.append(self._connect())
+            self._size += 1
+
+    def _connect(self):
+        "Open and authenticate a new connection."
+        knuckleball = client.Knuckleball(self._host, self._port, self._timeout_in_seconds, self._password,
+                                         hooks=self._hooks,
+                                         connect_timeout_in_seconds=self._connect_timeout_in_seconds,
+                                         send_buffer_size=self._send_buffer_size,
+                                         receive_buffer_size=self._receive_buffer_size)
+        with self._condition:
+            self._created += 1
+        return knuckleball
+
+    def _is_healthy(self, knuckleball):
+        "Return whether a connection taken from the idle ones can be borrowed."
+        if not knuckleball.is_healthy():
+            return False
+        if self._health_check is not None:
+            try:
+                # The check is not a command of the application, so it is kept from the hooks.
+                client.Knuckleball._parse(knuckleball._request(self._health_check), None)
+            except Exception:
+                return False
+        return True
+
+    def _discard(self, knuckleball):
+        "Close a borrowed connection and free its place in the pool."
+        try:
+            knuckleball.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._size -= 1
+            self._in_use -= 1
+            self._discarded += 1
+            self._condition.notify()
+
+    def acquire(self, block=True, timeout=None):
+        "Borrow a connection, waiting up to timeout seconds for one if block is set, or raise an error."
+        started = _now()
+        while True:
+            with self._condition:
+                if self._closed:
+                    raise exception.KnuckleballException('connection pool closed.')
+                while not self._idle and self._size >= self._max_size:
+                    remaining = None if timeout is None else started + timeout - _now()
+                    if not block or (remaining is not None and remaining <= 0):
+                        self._timeouts += 1
+                        raise exception.PoolTimeoutException('no connection available.')
+                    self._condition.wait(remaining)
+                    if self._closed:
+                        raise exception.KnuckleballException('connection pool closed.')
+                knuckleball = self._idle.pop() if self._idle else None
+                if knuckleball is None:
+                    self._size += 1
+                self._in_use += 1
+            if knuckleball is None:
+                try:
+                    knuckleball = self._connect()
+                except:
+                    with self._condition:
+                        self._size -= 1
+                        self._in_use -= 1
+                        self._condition.notify()
+                    raise
+            elif not self._is_healthy(knuckleball):
+                self._discard(knuckleball)
+                continue
+            waited = _now() - started
+            with self._condition:
+                self._acquisitions += 1
+                self._wait_seconds_total += waited
+                self._wait_seconds_max = max(self._wait_seconds_max, waited)
+            return knuckleball
+
+    def release(self, knuckleball):
+        "Return a borrowed connection to the pool, discarding it if it is waiting for a reply."
+        if knuckleball._pending_replies or self._closed:
+            self._discard(knuckleball)
+            return
+        with self._condition:
+            self._idle.append(knuckleball)
+            self._in_use -= 1
+            self._condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self, block=True, timeout=None):
+        "Borrow a connection for the duration of a with block."
+        knuckleball = self.acquire(block, timeout)
+        try:
+            yield knuckleball
+        finally:
+            self.release(knuckleball)
+
+    def execute(self, command, expect=None):
+        "Execute a command in a borrowed connection and return the result, of the expected type, or raise an error."
+        with self.connection() as knuckleball:
+            return knuckleball.execute(command, expect)
+
+    def close(self):
+        "Close the idle connections. Borrowed connections are closed when they are returned."
+        with self._condition:
+            idle, self._idle = self._idle, collections.deque()
+            self._size -= len(idle)
+            self._closed = True
+            self._condition.notify_all()
+        for knuckleball in idle:
+            knuckleball.close()
+
+    def stats(self):
+        "Return a dictionary with the size of the pool, its utilization and how long borrowers waited."
+        with self._condition:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'max_size': self._max_size,
+                'utilization': float(self._in_use) / self._max_size if self._max_size else 0.0,
+                'acquisitions': self._acquisitions,
+                'timeouts': self._timeouts,
+                'created': self._created,
+                'discarded': self._discarded,
+                'wait_seconds_total': self._wait_seconds_total,
+                'wait_seconds_max': self._wait_seconds_max,
+            }
@@ -0,0 +1,330 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import array
+import operator
+import re
+
+from knuckleball import exception
+from knuckleball import lazy
+from knuckleball import parser
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Number of characters of a numeric reply decoded at a time into an array.
+_BATCH_SIZE = 1 << 16
+
+def _mismatch(data, expected):
+    "Raise the error of the server, or an error saying that data is not of the expected type."
+    if parser.is_error(data):
+        raise exception.KnuckleballException(data)
+    shown = data if len(data) <= 40 else data[:40] + '...'
+    raise exception.TypeMismatchException('expected %s, got %s.' % (expected.name, shown))
+
+def _tokens(token, data, start, end):
+    "Return the comma separated elements of data[start:end] matched by token, or None if there is anything else."
+    # findall skips what token does not match, so the elements and commas found must add up to the whole text. Only
+    # the last element may be followed by the end of the text instead of a comma.
+    if start == end:
+        return []
+    tokens = token.findall(data, start, end)
+    if sum(map(len, tokens)) + len(tokens) - (data[end - 1] != ',') != end - start:
+        return None
+    return tokens
+
+class ScalarType:
+    def __init__(self, name, pattern, decode):
+        "Describe a type whose values match pattern, which has no groups, and are decoded by decode."
+        self.name = name
+        self.pattern = pattern
+        self.decode = decode
+        self._value = re.compile('(?:%s)\\Z' % pattern, re.S | re.U)
+        self._token = re.compile('(%s)(?:,|\\Z)' % pattern, re.S | re.U)
+
+    def __repr__(self):
+        return self.name
+
+    def parse(self, data):
+        "Parse a response that must be of this type and return its value or raise an error."
+        if self._value.match(data) is None:
+            _mismatch(data, self)
+        return self.decode(data)
+
+def _decode_null(token):
+    "Return the value of null, which is None."
+    return None
+
+Null = ScalarType('null', 'null', _decode_null)
+Boolean = ScalarType('Boolean', 'true|false', 'true'.__eq__)
+Character = ScalarType('Character', "'.'", operator.itemgetter(1))
+Integer = ScalarType('Integer', r'[+-]?\d+', int)
+Float = ScalarType('Float', r'[+-]?\d+(?:\.\d+)?', float)
+String = ScalarType('String', r'"[^"\\]*(?:\\.[^"\\]*)*"', parser._decode_string)
+Name = ScalarType('Name', r'[^\W\d_]\w*(?:::[^\W\d_]\w*)?', str)
+
+def _check_element(element):
+    "Raise an error if element cannot be in a container."
+    if not isinstance(element, ScalarType) or element is Null:
+        raise TypeError('%r cannot be an element of a container.' % (element,))
+
+class CollectionType:
+    def __init__(self, name, opening, closing, element, container):
+        "Describe a Vector or a Set of elements of a scalar type."
+        _check_element(element)
+        self.name = '%s<%s>' % (name, element.name)
+        self._opening = opening
+        self._closing = closing
+        self._element = element
+        self._container = container
+
+    def __repr__(self):
+        return self.name
+
+    def parse(self, data):
+        "Parse a response that must be of this type and return its value or raise an error."
+        end = len(data) - 1
+        if end < 1 or data[0] != self._opening or data[end] != self._closing:
+            _mismatch(data, self)
+        tokens = _tokens(self._element._token, data, 1, end)
+        if tokens is None:
+            _mismatch(data, self)
+        return self._container(map(self._element.decode, tokens))
+
+class DictionaryType:
+    def __init__(self, key, value):
+        "Describe a Dictionary from keys of a scalar type to values of a scalar type."
+        _check_element(key)
+        _check_element(value)
+        self.name = 'Dictionary<%s, %s>' % (key.name, value.name)
+        self._key = key
+        self._value = value
+        self._pair = re.compile(r'\((%s),(%s)(,?)\)(?:,|\Z)' % (key.pattern, value.pattern), re.S | re.U)
+
+    def __repr__(self):
+        return self.name
+
+    def parse(self, data):
+        "Parse a response that must be of this type and return its value or raise an error."
+        end = len(data) - 1
+        if end < 1 or data[0] != '(' or data[end] != ')':
+            _mismatch(data, self)
+        pairs = self._pair.findall(data, 1, end) if end > 1 else []
+        # As in _tokens, the pairs found must add up to the whole text.
+        if end > 1 and sum(len(k) + len(v) + len(c) + 4 for k, v, c in pairs) - (data[end - 1] != ',') != end - 1:
+            _mismatch(data, self)
+        decode_key, decode_value = self._key.decode, self._value.decode
+        return dict((decode_key(key), decode_value(value)) for key, value, _ in pairs)
+
+class _NumericArrayType:
+    def __init__(self, name, element):
+        "Describe a Vector or a Set of Integers or Floats decoded into a compact array."
+        if element is not Integer and element is not Float:
+            raise TypeError('%r cannot be an element of an array.' % (element,))
+        self.name = '%s<%s>' % (name, element.name)
+        self._element = element
+        self._dtype = None if numpy is None else numpy.int64 if element is Integer else numpy.float64
+        # Only ASCII digits are matched, as NumPy reads no others. Python 2 has no re.A, and matches only those anyway.
+        self._batch = re.compile('{0}(?:,{0})*\\Z'.format('(?:%s)' % element.pattern), getattr(re, 'A', 0))
+
+    def __repr__(self):
+        return self.name
+
+    def _batches(self, data):
+        "Yield batches of comma separated elements of a reply, without commas around, or raise an error."
+        end = len(data) - 1
+        if end < 1 or data[0] + data[end] not in ('[]', '{}'):
+            _mismatch(data, self)
+        start = 1
+        while start < end:
+            stop = data.find(',', start + _BATCH_SIZE, end) if start + _BATCH_SIZE < end else -1
+            if stop < 0:
+                stop = end - 1 if data[end - 1] == ',' else end
+            if self._batch.match(data, start, stop) is None:
+                _mismatch(data, self)
+            yield data[start:stop]
+            start = stop + 1
+
+    def _decode(self, data, batch):
+        "Decode a batch of a reply into a NumPy array in one call or raise an error."
+        # NumPy saturates Integers that do not fit in 64 bits. Only those of 19 characters or more may not, so the
+        # lengths of the elements are checked first, and just those elements are converted to be compared.
+        if self._element is Integer:
+            codes = numpy.frombuffer(batch.encode('ascii'), numpy.uint8)
+            bounds = numpy.concatenate(([-1], numpy.flatnonzero(codes == ord(',')), [len(codes)]))
+            for i in numpy.flatnonzero(numpy.diff(bounds) > 19):
+                if not -2 ** 63 <= int(batch[bounds[i] + 1:bounds[i + 1]]) < 2 ** 63:
+                    _mismatch(data, self)
+        return numpy.fromstring(batch, self._dtype, sep=',')
+
+class ArrayType(_NumericArrayType):
+    def __init__(self, element):
+        "Describe a Vector or a Set of Integers or Floats decoded into an array.array of int64 or double."
+        _NumericArrayType.__init__(self, 'Array', element)
+        self._typecode = 'q' if element is Integer else 'd'
+
+    def parse(self, data):
+        "Parse a response that must be of this type and return its elements in an array.array or raise an error."
+        # Without NumPy, elements are decoded one at a time.
+        values = array.array(self._typecode)
+        for batch in self._batches(data):
+            if self._dtype is not None:
+                values.frombytes(memoryview(self._decode(data, batch)).cast('B'))
+                continue
+            try:
+                values.extend(map(self._element.decode, batch.split(',')))
+            except OverflowError:
+                _mismatch(data, self)
+        return values
+
+class NDArrayType(_NumericArrayType):
+    def __init__(self, element):
+        "Describe a Vector or a Set of Integers or Floats decoded into a NumPy array of int64 or float64."
+        if numpy is None:
+            raise ImportError('NumPy is required to decode into NumPy arrays.')
+        _NumericArrayType.__init__(self, 'NDArray', element)
+
+    def parse(self, data):
+        "Parse a response that must be of this type and return its elements in a NumPy array or raise an error."
+        arrays = [self._decode(data, batch) for batch in self._batches(data)]
+        return numpy.concatenate(arrays) if arrays else numpy.empty(0, self._dtype)
+
+# Any element of a container, as in parser._ELEMENT, in UTF-8. Names with other letters than ASCII ones are matched
+# loosely and checked once decoded.
+_ANY_BYTES = br'''"[^"\\]*(?:\\.[^"\\]*)*"|'(?:[\x00-\x7f]|[\xc0-\xf7][\x80-\xbf]+)'|[+-]?\d+(?:\.\d+)?|(?:[A-Za-z\x80-\xff][\w\x80-\xff]*)(?:::[A-Za-z\x80-\xff][\w\x80-\xff]*)?'''
+
+class LazyType:
+    def __init__(self):
+        "Describe any reply, decoding Vectors, Sets and Dictionaries into lazy containers backed by the reply bytes."
+        self.name = 'Lazy'
+        self._bytes_token = re.compile(b'(' + _ANY_BYTES + br')(?:,|\Z)', re.S)
+        self._bytes_pair = re.compile(br'\((' + _ANY_BYTES + b'),(' + _ANY_BYTES + br')(,?)\)(?:,|\Z)', re.S)
+
+    def __repr__(self):
+        return self.name
+
+    def parse(self, data):
+        "Parse a response, scanning containers once for the offsets of their elements, or raise an error."
+        end = len(data) - 1
+        if end < 1 or data[0] + data[end] not in ('[]', '{}', '()'):
+            return parser.parse(data)
+        # Text is encoded once and scanned as bytes, as received replies are, so that offsets are in bytes and no
+        # element is copied while scanning.
+        return self._containers(data.encode('utf8'), not _is_ascii(data))
+
+    def parse_bytes(self, data):
+        "Parse a response in the UTF-8 bytes received, which lazy containers keep reading from, or raise an error."
+        end = len(data) - 1
+        if end < 1 or data[:1] + data[end:] not in (b'[]', b'{}', b'()'):
+            return parser.parse(data.decode('utf8'))
+        return self._containers(data, not _is_ascii(data))
+
+    def parse_spill(self, spill):
+        "Parse a response received into a connection.Spill, whose mmap lazy containers keep reading from."
+        buffer = spill.buffer
+        end = len(buffer) - 1
+        if end < 1 or buffer[:1] + buffer[end:] not in (b'[]', b'{}', b'()'):
+            with spill:
+                return parser.parse(spill.decode())
+        try:
+            return self._containers(buffer)
+        except:
+            spill.close()
+            raise
+
+    def _containers(self, buffer, check=True):
+        "Return the lazy container of a Vector, Set or Dictionary in a bytes-like buffer or raise an error."
+        end = len(buffer) - 1
+        if buffer[:1] == b'(':
+            return lazy.LazyDictionary(buffer, self._buffer_pairs(buffer, end, check))
+        container = lazy.LazyVector if buffer[:1] == b'[' else lazy.LazySet
+        return container(buffer, self._buffer_offsets(buffer, end, check))
+
+    def _buffer_offsets(self, buffer, end, check=True):
+        "Return the offsets of the elements of a Vector or a Set in a bytes-like buffer or raise an error."
+        # The elements are matched one at a time, so that only the offsets take memory. Names need no check when the
+        # buffer is known to be ASCII.
+        offsets = array.array('q')
+        pos = 1
+        for match in self._bytes_token.finditer(buffer, 1, end):
+            if match.start() != pos:
+                break
+            if check:
+                _check_bytes(match.group(1))
+            offsets.append(pos)
+            pos = match.end()
+        if pos != end:
+            raise exception.KnuckleballException('invalid value.')
+        offsets.append(end if buffer[end - 1:end] == b',' else end + 1)
+        return offsets
+
+    def _buffer_pairs(self, buffer, end, check=True):
+        "Return the offsets of the keys and values of a Dictionary in a bytes-like buffer or raise an error."
+        offsets = array.array('q')
+        pos = 1
+        for match in self._bytes_pair.finditer(buffer, 1, end):
+            if match.start() != pos:
+                break
+            if check:
+                _check_bytes(match.group(1))
+                _check_bytes(match.group(2))
+            offsets.extend((match.start(1), match.end(1), match.end(2)))
+            pos = match.end()
+        if pos != end:
+            raise exception.KnuckleballException('invalid value.')
+        return offsets
+
+def _is_ascii(data):
+    "Return whether a string, or bytes, has only ASCII characters."
+    try:
+        return data.isascii()
+    except AttributeError:
+        return max(data) < ('\x80' if isinstance(data, str) else 0x80)
+
+def _check_bytes(token):
+    "Raise an error if a UTF-8 element matched by _ANY_BYTES is a name with characters that are not letters."
+    if not _is_ascii(token) and token[:1] not in (b'"', b"'") and Name._value.match(token.decode('utf8')) is None:
+        raise exception.KnuckleballException('invalid value.')
+
+class _Generic:
+    def __init__(self, build):
+        "Build the types of a generic, such as Vector[Integer], once for each parameter."
+        self._build = build
+        self._types = {}
+
+    def __getitem__(self, parameters):
+        if not isinstance(parameters, tuple):
+            parameters = (parameters,)
+        built = self._types.get(parameters)
+        if built is None:
+            built = self._types[parameters] = self._build(*parameters)
+        return built
+
+Vector = _Generic(lambda element: CollectionType('Vector', '[', ']', element, list))
+Set = _Generic(lambda element: CollectionType('Set', '{', '}', element, set))
+Dictionary = _Generic(DictionaryType)
+Array = _Generic(ArrayType)
+NDArray = _Generic(NDArrayType)
+Lazy = LazyType()
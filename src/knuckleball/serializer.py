@@ -0,0 +1,77 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import decimal
+import math
+import sys
+
+if sys.version_info >= (3, 0):
+    _INTEGER_TYPES = (int,)
+    _STRING_TYPES = (str,)
+else:
+    _INTEGER_TYPES = (int, long)
+    _STRING_TYPES = (str, unicode)
+
+class Character(str):
+    "A str of length 1 that is written as a Knuckleball Character instead of a String."
+    def __new__(cls, value):
+        if len(value) != 1 or value == '\n':
+            raise ValueError('%r is not a Character.' % value)
+        return str.__new__(cls, value)
+
+def serialize(value):
+    "Return the Knuckleball literal of a Python value or raise an error."
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, _INTEGER_TYPES):
+        return str(value)
+    if isinstance(value, float):
+        return serialize_float(value)
+    if isinstance(value, Character):
+        return "'%s'" % value
+    if isinstance(value, _STRING_TYPES):
+        return serialize_string(value)
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ','.join(serialize(element) for element in value)
+    if isinstance(value, (set, frozenset)):
+        return '{%s}' % ','.join(serialize(element) for element in value)
+    if isinstance(value, dict):
+        return '(%s)' % ','.join('(%s,%s)' % (serialize(key), serialize(element)) for key, element in value.items())
+    raise TypeError('%s has no Knuckleball literal.' % type(value).__name__)
+
+def serialize_string(value):
+    "Return the Knuckleball String literal of value or raise an error."
+    # The server only unescapes '\"', so a backslash cannot precede a quote or end the string.
+    if value.endswith('\\') or '\\"' in value or '\n' in value:
+        raise ValueError('%r has no Knuckleball literal.' % value)
+    return '"%s"' % value.replace('"', '\\"')
+
+def serialize_float(value):
+    "Return the Knuckleball Float literal of value, in the digits.digits form without exponent, or raise an error."
+    if math.isinf(value) or math.isnan(value):
+        raise ValueError('%r has no Knuckleball literal.' % value)
+    # The shortest digits that read back as value, from repr, are written out in fixed point.
+    literal = format(decimal.Decimal(repr(value)), 'f')
+    return literal if '.' in literal else literal + '.0'
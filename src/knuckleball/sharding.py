@@ -0,0 +1,221 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import bisect
+import concurrent.futures
+import hashlib
+import re
+import threading
+
+from knuckleball import cache
+from knuckleball import client
+from knuckleball import connection
+from knuckleball import exception
+
+_CREATED = re.compile(r'\s*([^\W\d_]\w*(?:::[^\W\d_]\w*)?)', re.U)
+
+def target(command):
+    "Return the variable a command reads or changes, including the one created by 'create:', or None."
+    normalized = cache.normalize(command)
+    variable, message = cache.split(normalized)
+    if variable is None and message == 'create:':
+        match = _CREATED.match(normalized, normalized.index('create:') + len('create:'))
+        if match is not None:
+            variable = match.group(1)
+    return variable
+
+def _hash(key):
+    "Return a 64-bit hash of a string."
+    return int(hashlib.md5(key.encode('utf8')).hexdigest()[:16], 16)
+
+class HashRing:
+    def __init__(self, nodes=(), replicas=160):
+        "Map keys to nodes by consistent hashing, placing replicas virtual nodes on the ring for each node."
+        self._replicas = replicas
+        self._points = [] # sorted hashes of virtual nodes
+        self._nodes = [] # node of each point
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(set(self._nodes))
+
+    def add(self, node):
+        "Place a node, a string, on the ring. Only the keys closest to its virtual nodes move to it."
+        for replica in range(self._replicas):
+            point = _hash('%s-%d' % (node, replica))
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._nodes.insert(index, node)
+
+    def remove(self, node):
+        "Remove a node from the ring, moving its keys to the nodes that follow its virtual nodes."
+        kept = [(point, other) for point, other in zip(self._points, self._nodes) if other != node]
+        self._points = [point for point, _ in kept]
+        self._nodes = [other for _, other in kept]
+
+    def node(self, key):
+        "Return the node of a key, the first one clockwise from its hash, or raise an error if there is none."
+        if not self._points:
+            raise exception.KnuckleballException('no servers.')
+        index = bisect.bisect(self._points, _hash(key))
+        return self._nodes[index if index < len(self._nodes) else 0]
+
+class ShardedKnuckleball:
+    def __init__(self, servers, timeout_in_seconds=None, password=None, replicas=160):
+        "Connect to every (host, port) or (URL, None) in servers and route each command to one by its variable."
+        # Threads may share this client, as each connection is used by one command or pipeline at a time, but not
+        # while servers are added or removed.
+        self._timeout_in_seconds = timeout_in_seconds
+        self._password = password
+        self._ring = HashRing(replicas=replicas)
+        self._shards = {} # URL -> Knuckleball
+        self._locks = {} # URL -> Lock held while the connection is used
+        self._executor = None
+        try:
+            for host, port in servers:
+                self.add_server(host, port)
+        except:
+            self.close()
+            raise
+
+    def add_server(self, host, port=None):
+        "Connect to one more server, at host and port or a URL in host. Variables moving to it are moved by the caller."
+        node = connection.address(host, port)
+        if node in self._shards:
+            return
+        self._shards[node] = client.Knuckleball(host, port, self._timeout_in_seconds, self._password)
+        self._locks[node] = threading.Lock()
+        self._ring.add(node)
+        self._reset_executor()
+
+    def remove_server(self, host, port=None):
+        "Disconnect from a server, routing its variables to the remaining ones."
+        node = connection.address(host, port)
+        knuckleball = self._shards.pop(node)
+        self._ring.remove(node)
+        self._reset_executor()
+        with self._locks.pop(node):
+            knuckleball.close()
+
+    def _reset_executor(self):
+        "Replace the threads that run pipelines, one per server."
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max(1, len(self._shards)))
+
+    def shard(self, command):
+        "Return the connection to the server of the variable a command targets, or raise an error."
+        return self._shards[self._node(command)]
+
+    def _node(self, command):
+        "Return the URL of the server of the variable a command targets, or raise an error."
+        variable = target(command)
+        if variable is None:
+            raise exception.KnuckleballException('command targets no variable, use execute_all.')
+        return self._ring.node(variable)
+
+    def execute(self, command, expect=None):
+        "Execute a command where its variable is and return the result, of the expected type, or raise an error."
+        return self._execute(self._node(command), command, expect)
+
+    def _execute(self, node, command, expect):
+        "Execute a command in a server, once its connection is free."
+        with self._locks[node]:
+            return self._shards[node].execute(command, expect)
+
+    def execute_all(self, command, expect=None):
+        "Execute a command, such as 'Context listVariables;', in every server and return {URL: result}."
+        futures = dict((node, self._executor.submit(self._execute, node, command, expect)) for node in self._shards)
+        return dict((node, future.result()) for node, future in futures.items())
+
+    def pipeline(self, max_commands=1000, max_bytes=1 << 20):
+        "Return a pipeline that sends queued commands to their servers in parallel, pipelined per server."
+        return ShardedPipeline(self, max_commands, max_bytes)
+
+    def close(self):
+        "Close the connections with every server."
+        if self._executor is not None:
+            self._executor.shutdown()
+        for knuckleball in self._shards.values():
+            knuckleball.close()
+
+class ShardedPipeline:
+    def __init__(self, sharded, max_commands=1000, max_bytes=1 << 20):
+        "Queue commands for each server, sending them in writes of up to max_commands or max_bytes."
+        self._sharded = sharded
+        self._max_commands = max_commands
+        self._max_bytes = max_bytes
+        self._queues = {} # URL -> [(position, command, expected type)]
+        self._size = 0
+        self._bytes = 0
+        self._results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        "Send the commands still queued, unless the block raised an error."
+        if exc_type is None:
+            self.flush()
+
+    def __len__(self):
+        return self._size
+
+    def add(self, command, expect=None):
+        "Queue a command, whose result is of the expected type, and return the pipeline."
+        position = len(self._results) + self._size
+        self._queues.setdefault(self._sharded._node(command), []).append((position, command, expect))
+        self._size += 1
+        self._bytes += len(command) + 1
+        if self._size >= self._max_commands or self._bytes >= self._max_bytes:
+            self.flush()
+        return self
+
+    def _run(self, node, queue):
+        "Send the commands queued for a server, once its connection is free, and return their results."
+        with self._sharded._locks[node]:
+            pipeline = self._sharded._shards[node].pipeline(self._max_commands, self._max_bytes)
+            for _, command, expect in queue:
+                pipeline.add(command, expect)
+            return pipeline.execute()
+
+    def flush(self):
+        "Send the queued commands, to every server at once, and read their results."
+        if not self._size:
+            return
+        queues, self._queues = self._queues, {}
+        results = [None] * self._size
+        self._size = self._bytes = 0
+        futures = [(queue, self._sharded._executor.submit(self._run, node, queue)) for node, queue in queues.items()]
+        offset = len(self._results)
+        for queue, future in futures:
+            for (position, _, _), result in zip(queue, future.result()):
+                results[position - offset] = result
+        self._results.extend(results)
+
+    def execute(self):
+        "Send the queued commands and return every result since the last call in call order, with errors in place."
+        self.flush()
+        results, self._results = self._results, []
+        return results
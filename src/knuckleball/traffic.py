@@ -0,0 +1,195 @@
+# Copyright (c) 2016, Rodrigo Alves Lima
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice, this list of conditions and the
+#        following disclaimer.
+# 
+#     2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the
+#        following disclaimer in the documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the name of knuckleball-py nor the names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import argparse
+import collections
+import json
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+
+from knuckleball import client
+from knuckleball import exception
+from knuckleball import metrics
+
+_now = getattr(time, 'monotonic', time.time)
+
+# A log starts with _MAGIC, followed by records of a _RECORD header and the UTF-8 command. The header has the
+# microseconds since the epoch when the command was sent, its latency in microseconds, the bytes of its reply, the
+# bytes of the command and whether it raised an error.
+_MAGIC = b'KBLOG\x01'
+_RECORD = struct.Struct('<QIIIB')
+
+Record = collections.namedtuple('Record', ['timestamp', 'latency_in_seconds', 'reply_size', 'error', 'command'])
+
+class Recorder(metrics.Hook):
+    def __init__(self, path):
+        "Append every command executed by the clients that have this hook to a log, as in Knuckleball(hooks=[...])."
+        # Pipelined, streamed and submitted commands are logged along with executed ones, as their hooks are called,
+        # but AsyncKnuckleball has no hooks, so its commands are not.
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(_MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def after(self, event):
+        seconds = sum(s for s in (event.send_seconds, event.wait_seconds, event.receive_seconds, event.parse_seconds)
+                      if s is not None)
+        command = event.command.encode('utf8')
+        header = _RECORD.pack(int((time.time() - seconds) * 1e6), min(int(seconds * 1e6), 0xffffffff),
+                              min(event.bytes_received, 0xffffffff), len(command), event.error is not None)
+        with self._lock:
+            self._file.write(header + command)
+
+    def flush(self):
+        "Write what is buffered to the log."
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        "Write what is buffered and close the log."
+        with self._lock:
+            self._file.close()
+
+def read_log(path):
+    "Yield the Records of a log written by a Recorder."
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError('%s is not a Knuckleball traffic log.' % path)
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            timestamp, latency, reply_size, size, error = _RECORD.unpack(header)
+            command = f.read(size)
+            if len(command) < size:
+                return # the log was cut while a record was written
+            yield Record(timestamp / 1e6, latency / 1e6, reply_size, bool(error), command.decode('utf8'))
+
+def percentile(values, fraction):
+    "Return the value below which a fraction of the sorted values are."
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+def replay(records, host, port=None, speed=1.0, connections=8, password=None, timeout_in_seconds=None):
+    "Execute recorded commands in as many connections, speed times as fast as recorded or as fast as possible if None."
+    # The connections are opened before the clock starts. When replaying at a speed, the latency of a command is
+    # measured from when it was due rather than from when a connection was free to send it, so that a slow server
+    # delaying the commands behind it shows in their latencies.
+    clients = []
+    try:
+        for _ in range(connections):
+            clients.append(client.Knuckleball(host, port, timeout_in_seconds, password))
+    except:
+        for knuckleball in clients:
+            knuckleball.close()
+        raise
+    commands = queue.Queue(connections * 64)
+    lock = threading.Lock()
+    latencies = []
+    errors = 0
+    def work(knuckleball):
+        nonlocal errors
+        while True:
+            item = commands.get()
+            if item is None:
+                break
+            due, command = item
+            if due is None:
+                due = _now()
+            try:
+                if knuckleball is None:
+                    knuckleball = client.Knuckleball(host, port, timeout_in_seconds, password)
+                knuckleball.execute(command)
+            except (exception.KnuckleballException, socket.error) as e:
+                if not isinstance(e, exception.KnuckleballException) and knuckleball is not None:
+                    knuckleball.close()
+                    knuckleball = None
+                with lock:
+                    errors += 1
+            with lock:
+                latencies.append(_now() - due)
+        if knuckleball is not None:
+            knuckleball.close()
+    threads = [threading.Thread(target=work, args=(knuckleball,)) for knuckleball in clients]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    started = _now()
+    first = None
+    for record in records:
+        due = None
+        if speed:
+            if first is None:
+                first = record.timestamp
+            due = started + (record.timestamp - first) / speed
+            delay = due - _now()
+            if delay > 0:
+                time.sleep(delay)
+        commands.put((due, record.command))
+    for _ in threads:
+        commands.put(None)
+    for thread in threads:
+        thread.join()
+    seconds = _now() - started
+    latencies.sort()
+    return {
+        'commands': len(latencies),
+        'errors': errors,
+        'seconds': seconds,
+        'commands_per_second': len(latencies) / seconds if seconds else 0.0,
+        'p50_seconds': percentile(latencies, 0.5),
+        'p90_seconds': percentile(latencies, 0.9),
+        'p99_seconds': percentile(latencies, 0.99),
+        'max_seconds': latencies[-1] if latencies else 0.0,
+    }
+
+def main(argv=None):
+    "Replay a traffic log against a server and print a JSON report."
+    arguments = argparse.ArgumentParser(prog='knuckleball-replay', description='Replay a Knuckleball traffic log.')
+    arguments.add_argument('log', help='log written by knuckleball.traffic.Recorder')
+    arguments.add_argument('url',
+                           help='server, such as knuckleball://localhost:8001 or knuckleball+unix:///run/kb.sock')
+    arguments.add_argument('--speed', type=float, default=1.0, help='replay this many times as fast as recorded')
+    arguments.add_argument('--max-speed', action='store_true', help='replay as fast as possible')
+    arguments.add_argument('--connections', type=int, default=8, help='number of concurrent connections')
+    arguments.add_argument('--password', help='password to authenticate with')
+    arguments.add_argument('--timeout', type=float, help='timeout of each connection in seconds')
+    options = arguments.parse_args(argv)
+    report = replay(read_log(options.log), options.url, speed=None if options.max_speed else options.speed,
+                    connections=options.connections, password=options.password,
+                    timeout_in_seconds=options.timeout)
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -25,11 +25,42 @@
 import os
 import sys
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')) # for benchmarks and their FakeServer
 
+import array
+import asyncio
+import concurrent.futures
+import contextlib
+import io
+import json
+import mmap
+import operator
+import random
+import socket
+import tempfile
+import threading
+import time
 import unittest
 
+import benchmarks
+from benchmarks.fakeserver import FakeServer
+from knuckleball import cache
+from knuckleball import connection
+from knuckleball import failover
+from knuckleball import lazy
+from knuckleball import memo
+from knuckleball import metrics
+from knuckleball import offload
+from knuckleball import parser
+from knuckleball import schema
+from knuckleball import serializer
+from knuckleball import sharding
+from knuckleball import traffic
+from knuckleball.async_client import AsyncKnuckleball, AsyncKnuckleballPool
 from knuckleball.client import Knuckleball
-from knuckleball.exception import KnuckleballException
+from knuckleball.exception import KnuckleballException, PoolTimeoutException, TypeMismatchException
+from knuckleball.pool import KnuckleballPool
+from legacy_parser import LegacyParser
 
 class KnuckleballTest(unittest.TestCase):
     def test_parse(self):
@@ -151,5 +182,1236 @@ class KnuckleballTest(unittest.TestCase):
         # wrong password
         self.assertRaises(KnuckleballException, Knuckleball, 'localhost', 8001, password='wrongpassword')
 
+class TCPConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer({
+            'name get;': '"S\u00e3o Jo\u00e3o \u26be"',
+            'big get;': '[%s]' % ','.join(['42'] * 100000),
+        })
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_recv_multibyte_characters_across_reads(self):
+        for read_size in (1, 2, 3, 5):
+            tcp_connection = connection.TCPConnection('127.0.0.1', self.server.port, read_size=read_size)
+            tcp_connection.send('name get;\n')
+            self.assertEqual(tcp_connection.recv(), '"S\u00e3o Jo\u00e3o \u26be"')
+
+    def test_recv_large_line(self):
+        tcp_connection = connection.TCPConnection('127.0.0.1', self.server.port, read_size=1024)
+        tcp_connection.send('big get;\nname get;\nbig get;\n')
+        self.assertEqual(len(tcp_connection.recv()), 300001)
+        self.assertEqual(tcp_connection.recv(), '"S\u00e3o Jo\u00e3o \u26be"')
+        self.assertEqual(len(tcp_connection.recv()), 300001)
+        self.assertTrue(tcp_connection.is_idle())
+
+    def test_resolver(self):
+        calls = []
+        getaddrinfo = socket.getaddrinfo
+        def counting_getaddrinfo(*args):
+            calls.append(args)
+            return getaddrinfo(*args)
+        resolver = connection.Resolver(ttl_in_seconds=0.05)
+        socket.getaddrinfo = counting_getaddrinfo
+        try:
+            addresses = resolver.resolve('localhost', self.server.port)
+            self.assertEqual(resolver.resolve('localhost', self.server.port), addresses)
+            self.assertEqual(len(calls), 1)
+            time.sleep(0.06)
+            resolver.resolve('localhost', self.server.port)
+            self.assertEqual(len(calls), 2)
+        finally:
+            socket.getaddrinfo = getaddrinfo
+
+    def test_forget_addresses_that_fail(self):
+        calls = []
+        getaddrinfo = socket.getaddrinfo
+        def moving_getaddrinfo(host, port, *args):
+            calls.append(host)
+            # The first resolution returns an address where nothing listens, as a host that has moved.
+            return getaddrinfo('127.0.0.1', 1 if len(calls) == 1 else port, *args)
+        connection.resolver.clear()
+        socket.getaddrinfo = moving_getaddrinfo
+        try:
+            self.assertRaises(socket.error, connection.TCPConnection, 'moved.example', self.server.port,
+                              connect_timeout_in_seconds=1.0)
+            connection.TCPConnection('moved.example', self.server.port).close()
+            self.assertEqual(len(calls), 2)
+        finally:
+            socket.getaddrinfo = getaddrinfo
+            connection.resolver.clear()
+
+    def test_connect_in_parallel(self):
+        v4, v6 = socket.AF_INET, socket.AF_INET6
+        addresses = [(v6, 1, 6, '', ('::1', 1)), (v6, 1, 6, '', ('::2', 2)), (v4, 1, 6, '', ('127.0.0.1', 3))]
+        self.assertEqual([address[4][1] for address in connection._interleave(addresses)], [1, 3, 2])
+        # An address that never answers, or fails right away without a route, must not delay the working one.
+        unreachable = (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('192.0.2.1', 9))
+        reachable = (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', self.server.port))
+        started = time.time()
+        sock = connection.connect([unreachable, reachable], timeout_in_seconds=5.0)
+        self.assertLess(time.time() - started, 1.0)
+        self.assertEqual(sock.getpeername()[1], self.server.port)
+        sock.close()
+        self.assertRaises(socket.error, connection.connect, [unreachable], timeout_in_seconds=0.1)
+        tcp_connection = connection.TCPConnection('localhost', self.server.port, timeout_in_seconds=1.0,
+                                                  connect_timeout_in_seconds=0.5)
+        self.assertEqual(tcp_connection._sock.gettimeout(), 1.0)
+        tcp_connection.send('name get;\n')
+        self.assertEqual(tcp_connection.recv(), '"S\u00e3o Jo\u00e3o \u26be"')
+        tcp_connection.close()
+
+    def test_connect_with_many_descriptors(self):
+        try:
+            import resource
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft < 1200 and (hard == resource.RLIM_INFINITY or hard >= 1200):
+                resource.setrlimit(resource.RLIMIT_NOFILE, (1200, hard))
+        except (ImportError, ValueError):
+            soft = hard = None
+        descriptors = []
+        try:
+            while not descriptors or descriptors[-1] <= 1024:
+                descriptors.append(os.dup(0))
+        except OSError:
+            self.skipTest('cannot open more than 1024 descriptors.')
+        try:
+            address = (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', self.server.port))
+            sock = connection.connect([address], timeout_in_seconds=5.0)
+            self.assertGreater(sock.fileno(), 1024)
+            sock.close()
+        finally:
+            for descriptor in descriptors:
+                os.close(descriptor)
+            if soft is not None:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    def test_unix_domain_socket(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'kb.sock')
+        try:
+            with FakeServer({'i get;': '42'}, path=path) as server:
+                self.assertEqual(server.url, 'knuckleball+unix://' + path)
+                knuckleball = Knuckleball(server.url, send_buffer_size=1 << 16, receive_buffer_size=1 << 16)
+                self.assertEqual(knuckleball.execute('i get;'), 42)
+                self.assertEqual(knuckleball.pipeline().add('i get;').add('i get;').execute(), [42, 42])
+                self.assertEqual(knuckleball._connection._sock.family, socket.AF_UNIX)
+                self.assertGreaterEqual(knuckleball._connection._sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+                                        1 << 16)
+                knuckleball.close()
+                pool = KnuckleballPool(server.url, max_size=2, send_buffer_size=1 << 16)
+                self.assertEqual(pool.execute('i get;'), 42)
+                with pool.connection() as knuckleball:
+                    self.assertGreaterEqual(
+                        knuckleball._connection._sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF), 1 << 16)
+                pool.close()
+                async def run():
+                    async with AsyncKnuckleball(server.url, send_buffer_size=1 << 16) as knuckleball:
+                        sock = knuckleball._writer.get_extra_info('socket')
+                        self.assertGreaterEqual(sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF), 1 << 16)
+                        return await knuckleball.execute('i get;')
+                self.assertEqual(asyncio.run(run()), 42)
+                async def run_pool():
+                    async with AsyncKnuckleballPool(server.url, send_buffer_size=1 << 16) as pool:
+                        knuckleball = await pool.acquire()
+                        return knuckleball._send_buffer_size, await knuckleball.execute('i get;')
+                self.assertEqual(asyncio.run(run_pool()), (1 << 16, 42))
+            self.assertRaises(socket.error, Knuckleball, 'knuckleball+unix://' + path)
+        finally:
+            os.rmdir(directory)
+        knuckleball = Knuckleball('knuckleball://127.0.0.1:%d' % self.server.port)
+        self.assertEqual(knuckleball._connection._sock.family, socket.AF_INET)
+        knuckleball.close()
+        self.assertRaises(ValueError, connection.open_connection, 'http://127.0.0.1:80')
+        self.assertRaises(ValueError, connection.open_connection, 'knuckleball://127.0.0.1')
+
+    def test_spill(self):
+        data = '[%s]' % ','.join('"player %d"' % i for i in range(10000))
+        with FakeServer({'players get;': data, 'i get;': '42'}, chunk_size=4096) as server:
+            knuckleball = Knuckleball('127.0.0.1', server.port, spill_threshold=1000)
+            self.assertEqual(knuckleball.execute('players get;'), parser.parse(data))
+            self.assertEqual(knuckleball.execute('i get;'), 42)
+            players = knuckleball.execute('players get;', expect=schema.Lazy)
+            self.assertIsInstance(players._buffer, mmap.mmap)
+            self.assertEqual((len(players), players[9999]), (10000, 'player 9999'))
+            self.assertEqual(knuckleball.execute('players get;', expect=schema.Vector[schema.String]), players[:])
+            self.assertEqual(knuckleball.pipeline().add('players get;').add('i get;').execute(), [list(players), 42])
+            self.assertTrue(knuckleball.is_healthy())
+            knuckleball.close()
+
+    def test_lazy_from_bytes(self):
+        data = '{"S\u00e3o","Jo\u00e3o"}'
+        with FakeServer({'players get;': data, 'i get;': '42'}) as server:
+            knuckleball = Knuckleball('127.0.0.1', server.port)
+            players = knuckleball.execute('players get;', expect=schema.Lazy)
+            self.assertEqual(players._vector._buffer, data.encode('utf8'))
+            self.assertEqual(players, set(['S\u00e3o', 'Jo\u00e3o']))
+            self.assertEqual(knuckleball.execute('i get;', expect=schema.Lazy), 42)
+            results = knuckleball.pipeline().add('players get;', expect=schema.Lazy).add('i get;').execute()
+            self.assertEqual((results[0]._vector._buffer, results[1]), (data.encode('utf8'), 42))
+            knuckleball.add_hook(metrics.MetricsCollector())
+            players = knuckleball.execute('players get;', expect=schema.Lazy)
+            self.assertEqual(players._vector._buffer, data.encode('utf8'))
+            knuckleball.close()
+
+    def test_recv_lines(self):
+        tcp_connection = connection.TCPConnection('127.0.0.1', self.server.port)
+        tcp_connection.send('name get;\n' * 3)
+        lines = []
+        while len(lines) < 3:
+            lines.extend(tcp_connection.recv_lines())
+        self.assertEqual(lines, ['"S\u00e3o Jo\u00e3o \u26be"'] * 3)
+        tcp_connection.send('name get;\n' * 3)
+        time.sleep(0.05)
+        self.assertEqual(len(tcp_connection.recv_lines(2)), 2)
+        self.assertFalse(tcp_connection.is_idle())
+        self.assertEqual(len(tcp_connection.recv_lines()), 1)
+
+class ExecuteIterTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer({
+            'big get;': '[%s]' % ','.join('"%d"' % i for i in range(100000)),
+            'ages get;': '(("Babe Ruth",53),("David Ortiz",50))',
+            'i get;': '42',
+        })
+        self.knuckleball = Knuckleball('127.0.0.1', self.server.port, read_size=1024)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_execute_iter(self):
+        count = 0
+        for i, value in enumerate(self.knuckleball.execute_iter('big get;')):
+            self.assertEqual(value, str(i))
+            count += 1
+        self.assertEqual(count, 100000)
+        self.assertEqual(list(self.knuckleball.execute_iter('ages get;')), [('Babe Ruth', 53), ('David Ortiz', 50)])
+        self.assertTrue(self.knuckleball.is_healthy())
+
+    def test_execute_iter_abandoned(self):
+        values = self.knuckleball.execute_iter('big get;')
+        self.assertEqual(next(values), '0')
+        values.close()
+        self.assertTrue(self.knuckleball.is_healthy())
+        self.assertEqual(self.knuckleball.execute('i get;'), 42)
+
+    def test_execute_iter_errors(self):
+        self.assertRaises(KnuckleballException, list, self.knuckleball.execute_iter('i get;'))
+        self.assertRaises(KnuckleballException, list, self.knuckleball.execute_iter('j get;'))
+        self.assertEqual(self.knuckleball.execute('i get;'), 42)
+
+class BulkLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer({}, default='null')
+        self.knuckleball = Knuckleball('127.0.0.1', self.server.port)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_serialize(self):
+        self.assertEqual(serializer.serialize('knuckle"ball'), '"knuckle\\"ball"')
+        self.assertEqual(serializer.serialize([True, 'a', -42, 1.5]), '[true,"a",-42,1.5]')
+        self.assertEqual(serializer.serialize({'a': 1}), '(("a",1))')
+        for value in ('a\\"b', 'a\\', 'a\nb', float('nan'), float('inf'), float('-inf')):
+            self.assertRaises(ValueError, serializer.serialize, value)
+        self.assertRaises(TypeError, serializer.serialize, None)
+        for value in (True, "'", 'knuckle"ball', 'a\\b', [1, -2.5, 'x'], set(['a', 'b']), {'a': 1, 'b': 2}):
+            self.assertEqual(Knuckleball.parse(serializer.serialize(value)), value)
+        # Python 2 longs and unicode strings, which Python 3 ints and strs stand for here.
+        self.assertEqual(serializer.serialize(2 ** 70), '1180591620717411303424')
+        self.assertEqual(serializer.serialize(u'S\u00e3o'), u'"S\u00e3o"')
+        self.assertEqual(serializer.serialize(1e20), '100000000000000000000.0')
+        self.assertEqual(serializer.serialize(1e-07), '0.0000001')
+        for value in (1e20, -1e-07, 1.2345678901234568e+17, 5e-324, 1.7976931348623157e+308, 0.1, -0.0, 42.0):
+            self.assertEqual(Knuckleball.parse(serializer.serialize(value)), value)
+
+    def test_bulk_load(self):
+        progress = []
+        players = ('player %d' % i if i != 7 else 'bad\\' for i in range(2500))
+        loaded, failures = self.knuckleball.bulk_load('players', players, max_commands=1000,
+                                                      progress=lambda *args: progress.append(args))
+        self.assertEqual(loaded, 2499)
+        self.assertEqual([(index, item) for index, item, _ in failures], [(7, 'bad\\')])
+        self.assertEqual(progress, [(1000, 1), (2000, 1), (2499, 1)])
+        self.assertEqual(self.server.commands[:2], ['players add: "player 0";', 'players add: "player 1";'])
+
+    def test_bulk_load_with_placeholders(self):
+        self.server.default = 'RuntimeError: invalid argument.'
+        self.server.replies['ages set: "Babe Ruth" withValue: 53;'] = 'null'
+        loaded, failures = self.knuckleball.bulk_load('ages', [('Babe Ruth', 53), ('David Ortiz', 50)],
+                                                      message='set: %s withValue: %s')
+        self.assertEqual(loaded, 1)
+        self.assertEqual(failures[0][:2], (1, ('David Ortiz', 50)))
+        self.assertIsInstance(failures[0][2], KnuckleballException)
+
+class CommandBuilderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer({
+            'Connection authenticateWithPassword: "secure\\"password";': 'null',
+            'Set<String> create: players;': 'null',
+            'players add: "Babe Ruth";': 'null',
+            'players add: "knuckle\\"ball";': 'null',
+            'players contains? "Babe Ruth";': 'true',
+            'players get;': '{"Babe Ruth"}',
+            "Character create: c withValue: 'x';": 'null',
+            'std::ages get;': '(("Babe Ruth",53))',
+        })
+        self.knuckleball = Knuckleball('127.0.0.1', self.server.port, password='secure"password')
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_variable(self):
+        players = self.knuckleball.var('players')
+        self.assertEqual(players.create('Set<String>'), None)
+        self.assertEqual(players.add('Babe Ruth'), None)
+        self.assertEqual(players.add('knuckle"ball'), None)
+        self.assertEqual(players.contains('Babe Ruth'), True)
+        self.assertEqual(players.get(), set(['Babe Ruth']))
+        self.assertEqual(self.knuckleball.var('c').create('Character', serializer.Character('x')), None)
+        self.assertEqual(self.knuckleball.var('ages', ns='std').get(), {'Babe Ruth': 53})
+        self.assertRaises(ValueError, self.knuckleball.var, 'players;')
+        self.assertRaises(KnuckleballException, players.remove, 'Babe Ruth')
+
+    def test_command(self):
+        add = self.knuckleball.command('players add: %s;')
+        self.assertIs(self.knuckleball.command('players add: %s;')._template, add._template)
+        self.assertEqual(add('Babe Ruth'), None)
+        self.assertRaises(TypeError, add)
+        contains = self.knuckleball.command('players contains? %s;', schema.Boolean)
+        self.assertEqual(contains('Babe Ruth'), True)
+        self.assertRaises(TypeMismatchException, self.knuckleball.command('players get;', schema.Boolean))
+        self.assertEqual(self.knuckleball.var('players', type=schema.Set[schema.String]).get(), set(['Babe Ruth']))
+        self.assertEqual(self.knuckleball.execute('players get;', expect=schema.Set[schema.String]), set(['Babe Ruth']))
+        self.assertRaises(TypeMismatchException, self.knuckleball.execute, 'players get;', schema.Vector[schema.String])
+        pipeline = self.knuckleball.pipeline().add('players get;', schema.Set[schema.String])
+        pipeline.add('players get;', schema.Set[schema.Integer])
+        results = pipeline.execute()
+        self.assertEqual(results[0], set(['Babe Ruth']))
+        self.assertIsInstance(results[1], TypeMismatchException)
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer({'i get;': '42', 'players get;': '{"Babe Ruth"}', 'players add: "X";': 'null'})
+        self.knuckleball = Knuckleball('127.0.0.1', self.server.port)
+        self.sends = []
+        send = self.knuckleball._connection.send
+        def counting_send(data):
+            self.sends.append(data)
+            send(data)
+        self.knuckleball._connection.send = counting_send
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_execute(self):
+        pipeline = self.knuckleball.pipeline()
+        pipeline.add('i get;').add('j get;').add('players get;')
+        self.assertEqual(len(pipeline), 3)
+        results = pipeline.execute()
+        self.assertEqual(len(self.sends), 1)
+        self.assertEqual(results[0], 42)
+        self.assertIsInstance(results[1], KnuckleballException)
+        self.assertEqual(results[2], set(['Babe Ruth']))
+        self.assertEqual(pipeline.execute(), [])
+        self.assertEqual(self.knuckleball.execute('i get;'), 42)
+
+    def test_context_manager(self):
+        with self.knuckleball.pipeline(max_commands=2) as pipeline:
+            for _ in range(5):
+                pipeline.add('players add: "X";')
+            self.assertEqual(len(self.sends), 2)
+        self.assertEqual(len(self.sends), 3)
+        self.assertEqual(pipeline.execute(), [None] * 5)
+        self.assertEqual(self.server.commands, ['players add: "X";'] * 5)
+
+class KnuckleballPoolTest(unittest.TestCase):
+    AUTHENTICATE = 'Connection authenticateWithPassword: "securepassword";'
+
+    def setUp(self):
+        self.server = FakeServer({self.AUTHENTICATE: 'null', 'i get;': '42', 'hang;': None})
+        self.pool = KnuckleballPool('127.0.0.1', self.server.port, timeout_in_seconds=0.2, password='securepassword',
+                                    min_size=1, max_size=2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.close()
+
+    def test_authenticates_once_per_connection(self):
+        for _ in range(5):
+            self.assertEqual(self.pool.execute('i get;'), 42)
+        self.assertEqual(self.server.commands.count(self.AUTHENTICATE), 1)
+        stats = self.pool.stats()
+        self.assertEqual((stats['size'], stats['idle'], stats['in_use'], stats['created']), (1, 1, 0, 1))
+        self.assertEqual(stats['acquisitions'], 5)
+
+    def test_checkout_timeout(self):
+        first, second = self.pool.acquire(), self.pool.acquire()
+        self.assertEqual(self.pool.stats()['utilization'], 1.0)
+        self.assertRaises(PoolTimeoutException, self.pool.acquire, block=False)
+        self.assertRaises(PoolTimeoutException, self.pool.acquire, timeout=0.05)
+        threading.Timer(0.05, self.pool.release, args=(first,)).start()
+        self.assertIs(self.pool.acquire(timeout=1.0), first)
+        self.assertGreater(self.pool.stats()['wait_seconds_max'], 0.0)
+        self.assertEqual(self.pool.stats()['timeouts'], 2)
+
+    def test_discards_connection_waiting_for_reply(self):
+        with self.pool.connection() as knuckleball:
+            self.assertRaises(socket.timeout, knuckleball.execute, 'hang;')
+        self.assertEqual(self.pool.stats()['discarded'], 1)
+        with self.pool.connection() as other:
+            self.assertIsNot(other, knuckleball)
+            self.assertEqual(other.execute('i get;'), 42)
+
+    def test_health_check_on_borrow(self):
+        with self.pool.connection() as knuckleball:
+            pass
+        self.server.drop_connections()
+        time.sleep(0.05)
+        with self.pool.connection() as other:
+            self.assertIsNot(other, knuckleball)
+            self.assertEqual(other.execute('i get;'), 42)
+        self.assertEqual(self.server.commands.count(self.AUTHENTICATE), 2)
+
+    def test_health_check_is_kept_from_hooks(self):
+        collector = metrics.MetricsCollector()
+        pool = KnuckleballPool('127.0.0.1', self.server.port, password='securepassword', health_check='i get;',
+                               hooks=[collector])
+        for _ in range(3):
+            with pool.connection() as knuckleball:
+                knuckleball.execute('i get;')
+        pool.close()
+        self.assertEqual(self.server.commands.count('i get;'), 5)
+        self.assertEqual(collector.stats()['get']['commands'], 3)
+
+class AsyncKnuckleballTest(unittest.TestCase):
+    AUTHENTICATE = 'Connection authenticateWithPassword: "securepassword";'
+
+    def setUp(self):
+        replies = dict(('v%d get;' % i, str(i)) for i in range(500))
+        replies[self.AUTHENTICATE] = 'null'
+        self.server = FakeServer(replies)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_concurrent_execute(self):
+        async def run():
+            async with AsyncKnuckleball('127.0.0.1', self.server.port, password='securepassword') as knuckleball:
+                return await asyncio.gather(*[knuckleball.execute('v%d get;' % i) for i in range(500)])
+        self.assertEqual(asyncio.run(run()), list(range(500)))
+        self.assertEqual(self.server.commands.count(self.AUTHENTICATE), 1)
+
+    def test_execute_in_other_processes(self):
+        class Deferred:
+            "Parse in another thread after a while, failing if the event loop blocks on parse."
+            def submit(self, data):
+                future = concurrent.futures.Future()
+                threading.Timer(0.05, lambda: future.set_result(parser.parse(data.decode('utf8')))).start()
+                return future
+            def parse(self, data):
+                raise AssertionError('parse blocks the event loop.')
+        async def run(process):
+            async with AsyncKnuckleball('127.0.0.1', self.server.port) as knuckleball:
+                deferred = asyncio.ensure_future(knuckleball.execute('v1 get;', expect=Deferred()))
+                other = await knuckleball.execute('v2 get;')
+                self.assertFalse(deferred.done())
+                pipeline = knuckleball.pipeline()
+                await pipeline.add('v3 get;', expect=process)
+                await pipeline.add('i get;', expect=process)
+                results = await pipeline.execute()
+                self.assertIsInstance(results[1], KnuckleballException)
+                return [await deferred, other, results[0], await knuckleball.execute('v4 get;', expect=process)]
+        with offload.ProcessParser(threshold=1) as process:
+            self.assertEqual(asyncio.run(run(process)), [1, 2, 3, 4])
+
+    def test_execute_error(self):
+        async def run():
+            async with AsyncKnuckleball('127.0.0.1', self.server.port) as knuckleball:
+                with self.assertRaises(KnuckleballException):
+                    await knuckleball.execute('i get;')
+                return await knuckleball.execute('v1 get;')
+        self.assertEqual(asyncio.run(run()), 1)
+
+    def test_pipeline(self):
+        async def run():
+            async with AsyncKnuckleball('127.0.0.1', self.server.port) as knuckleball:
+                async with knuckleball.pipeline(max_commands=2) as pipeline:
+                    for command in ('v1 get;', 'i get;', 'v2 get;'):
+                        await pipeline.add(command)
+                return await pipeline.execute()
+        results = asyncio.run(run())
+        self.assertEqual(results[0], 1)
+        self.assertIsInstance(results[1], KnuckleballException)
+        self.assertEqual(results[2], 2)
+
+    def test_pool(self):
+        async def run():
+            async with AsyncKnuckleballPool('127.0.0.1', self.server.port, password='securepassword',
+                                            size=3) as pool:
+                results = await asyncio.gather(*[pool.execute('v%d get;' % i) for i in range(500)])
+                return results, pool.stats()
+        results, stats = asyncio.run(run())
+        self.assertEqual(results, list(range(500)))
+        self.assertLessEqual(stats['size'], 3)
+        self.assertEqual(self.server.commands.count(self.AUTHENTICATE), stats['size'])
+
+    def test_connection_closed(self):
+        async def run():
+            async with AsyncKnuckleball('127.0.0.1', self.server.port) as knuckleball:
+                await knuckleball.execute('v0 get;')
+                self.server.drop_connections()
+                with self.assertRaises(socket.error):
+                    await knuckleball.execute('v1 get;')
+                self.assertFalse(knuckleball.is_connected())
+        asyncio.run(run())
+
+class CachedKnuckleballTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer({
+            'players get;': '{"Babe Ruth"}',
+            'players contains? "X";': 'false',
+            'players add: "X";': 'null',
+            'ages get;': '()',
+            'Context listVariables;': '[ages,players]',
+            'Set<String> create: ids;': 'null',
+        })
+        self.knuckleball = cache.CachedKnuckleball(Knuckleball('127.0.0.1', self.server.port), max_entries=3)
+
+    def tearDown(self):
+        self.knuckleball.close()
+        self.server.close()
+
+    def test_normalize(self):
+        self.assertEqual(cache.normalize('  players   add:  "Babe  Ruth" ;'), 'players add: "Babe  Ruth" ;')
+        self.assertEqual(cache.normalize("s add: ' ';"), "s add: ' ';")
+        self.assertEqual(cache.split('std::ages get;'), ('std::ages', 'get'))
+        self.assertEqual(cache.split('players contains? "X";'), ('players', 'contains?'))
+        self.assertEqual(cache.split('Dictionary<String, Integer> create: ages;'), (None, 'create:'))
+
+    def test_hits_and_invalidation(self):
+        for _ in range(3):
+            self.assertEqual(self.knuckleball.execute('players get;'), set(['Babe Ruth']))
+            self.assertEqual(self.knuckleball.execute('players contains? "X";'), False)
+            self.assertEqual(self.knuckleball.execute('ages get;'), {})
+        self.assertEqual(len(self.server.commands), 3)
+        self.knuckleball.execute('players get;').add('David Ortiz')
+        self.assertEqual(self.knuckleball.execute('players get;'), set(['Babe Ruth']))
+        self.assertEqual(self.knuckleball.execute('players add: "X";'), None)
+        self.knuckleball.execute('players get;')
+        self.knuckleball.execute('ages get;')
+        self.assertEqual(self.server.commands.count('players get;'), 2)
+        self.assertEqual(self.server.commands.count('ages get;'), 1)
+        self.knuckleball.execute('Set<String> create: ids;')
+        self.knuckleball.execute('ages get;')
+        self.assertEqual(self.server.commands.count('ages get;'), 2)
+        stats = self.knuckleball.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['invalidations']), (9, 5, 4))
+
+    def test_bypass_lru_and_ttl(self):
+        self.knuckleball.execute('players get;')
+        self.knuckleball.execute('players get;', cache=False)
+        self.assertEqual(self.server.commands.count('players get;'), 2)
+        for command in ('players contains? "X";', 'ages get;', 'Context listVariables;'):
+            self.knuckleball.execute(command)
+        self.assertEqual(self.knuckleball.stats()['evictions'], 1)
+        self.knuckleball.execute('players get;')
+        self.assertEqual(self.server.commands.count('players get;'), 3)
+        knuckleball = cache.CachedKnuckleball(self.knuckleball, ttl_in_seconds=0.01)
+        knuckleball.execute('ages get;')
+        time.sleep(0.02)
+        knuckleball.execute('ages get;')
+        self.assertEqual(knuckleball.stats()['misses'], 2)
+
+class BenchmarksTest(unittest.TestCase):
+    def report(self, **results):
+        return {'results': results}
+
+    def test_compare(self):
+        baseline = self.report(parse={'seconds': 1.0, 'items_per_second': 1000.0}, pool={'seconds': 2.0})
+        self.assertEqual(benchmarks.compare(baseline, baseline), [])
+        report = self.report(parse={'seconds': 1.2, 'items_per_second': 850.0}, pool={'seconds': 1.0})
+        self.assertEqual(benchmarks.compare(baseline, report),
+                         [('parse', 'items_per_second', 1000.0, 850.0), ('parse', 'seconds', 1.0, 1.2)])
+        self.assertEqual(benchmarks.compare(baseline, report, threshold=0.2), [])
+        report = self.report(parse={'seconds': 1.25, 'items_per_second': 750.0}) # exactly at the threshold
+        self.assertEqual(benchmarks.compare(baseline, report, threshold=0.25), [])
+        report = self.report(parse={'seconds': 0.5, 'items_per_second': 2000.0}) # improvements
+        self.assertEqual(benchmarks.compare(baseline, report), [])
+
+    def test_compare_skips_what_the_baseline_lacks(self):
+        baseline = self.report(parse={'seconds': 0.0})
+        report = self.report(parse={'seconds': 5.0, 'bytes': 10}, new={'seconds': 5.0})
+        self.assertEqual(benchmarks.compare(baseline, report), [])
+
+    def test_run_keeps_the_best_run(self):
+        runs = iter([{'seconds': 2.0, 'items_per_second': 10.0}, {'seconds': 1.0, 'items_per_second': 5.0},
+                     {'seconds': 3.0, 'items_per_second': 20.0}])
+        benchmarks.BENCHMARKS['test_only'] = lambda scale: next(runs)
+        try:
+            lines = []
+            report = benchmarks.run('test_only', repeat=3, scale=0.5, log=lines.append)
+        finally:
+            del benchmarks.BENCHMARKS['test_only']
+        self.assertEqual(report['results'], {'test_only': {'seconds': 1.0, 'items_per_second': 20.0}})
+        self.assertEqual((report['repeat'], report['scale']), (3, 0.5))
+        self.assertEqual(lines, ['test_only items_per_second=20 seconds=1'])
+        self.assertTrue(benchmarks.is_rate('items_per_second'))
+        self.assertFalse(benchmarks.is_rate('seconds'))
+
+class MetricsTest(unittest.TestCase):
+    def test_verb(self):
+        self.assertEqual(metrics.verb('players add: "Babe Ruth";'), 'add:')
+        self.assertEqual(metrics.verb('  std::ages  get ;'), 'get')
+        self.assertEqual(metrics.verb('Dictionary<String, Integer> create: ages;'), 'create:')
+        self.assertEqual(metrics.verb('players set: 0 withValue: 1;'), 'set:')
+
+    def test_collector(self):
+        events = []
+        class Recorder(metrics.Hook):
+            def before(self, command):
+                events.append(command)
+        collector = metrics.MetricsCollector()
+        with FakeServer({'players get;': '{"Babe Ruth"}', 'Connection authenticateWithPassword: "secret";': 'null'}) \
+                as server:
+            knuckleball = Knuckleball('127.0.0.1', server.port, password='secret', hooks=[collector])
+            knuckleball.add_hook(Recorder())
+            self.assertEqual(knuckleball.execute('players get;'), set(['Babe Ruth']))
+            self.assertRaises(KnuckleballException, knuckleball.execute, 'players add: 1;')
+            self.assertRaises(TypeMismatchException, knuckleball.execute, 'players get;', schema.Integer)
+            self.assertEqual(events, ['players get;', 'players add: 1;', 'players get;'])
+            knuckleball.close()
+        stats = collector.stats()
+        self.assertEqual(sorted(stats), ['add:', 'get'])
+        self.assertEqual(stats['get']['commands'], 2)
+        self.assertEqual(stats['get']['errors'], {'TypeMismatchException': 1})
+        self.assertEqual(stats['get']['bytes_sent'], 2 * len('players get;\n'))
+        self.assertEqual(stats['get']['bytes_received'], 2 * len('{"Babe Ruth"}\n'))
+        self.assertEqual(stats['add:']['errors'], {'KnuckleballException': 1})
+        for phase in metrics.PHASES + ('total',):
+            self.assertEqual(stats['get']['seconds'][phase]['count'], 2)
+        exported = collector.export()
+        self.assertIn('# TYPE knuckleball_command_seconds histogram', exported)
+        self.assertIn('knuckleball_commands_total{verb="get"} 2', exported)
+        self.assertIn('knuckleball_errors_total{verb="add:",type="KnuckleballException"} 1', exported)
+        self.assertIn('knuckleball_command_seconds_bucket{verb="get",phase="wait",le="+Inf"} 2', exported)
+        self.assertIn('knuckleball_response_bytes_bucket{verb="get",le="64"} 2', exported)
+        collector.reset()
+        self.assertEqual(collector.stats(), {})
+
+    def test_pipeline_and_execute_iter_events(self):
+        events = []
+        class Recorder(metrics.Hook):
+            def after(self, event):
+                events.append(event)
+        replies = {'players get;': '{"Babe Ruth"}', 'i get;': '42', 'x get;': 'RuntimeError: unknown variable.',
+                   'players add: 1;': 'null', 'players add: 2;': 'null'}
+        with FakeServer(replies) as server:
+            knuckleball = Knuckleball('127.0.0.1', server.port, hooks=[Recorder()])
+            results = knuckleball.pipeline().add('i get;').add('x get;').add('players get;', schema.Integer).execute()
+            self.assertEqual(results[0], 42)
+            self.assertEqual([event.command for event in events], ['i get;', 'x get;', 'players get;'])
+            self.assertEqual([event.bytes_received for event in events], [3, 32, 14])
+            self.assertEqual([type(event.error).__name__ for event in events],
+                             ['NoneType', 'KnuckleballException', 'TypeMismatchException'])
+            for event in events:
+                self.assertEqual((event.bytes_sent, event.wait_seconds), (len(event.command) + 1, None))
+                self.assertTrue(event.send_seconds >= 0 and event.receive_seconds >= 0 and event.parse_seconds >= 0)
+            del events[:]
+            self.assertEqual(list(knuckleball.execute_iter('players get;')), ['Babe Ruth'])
+            self.assertRaises(KnuckleballException, list, knuckleball.execute_iter('x get;'))
+            self.assertEqual([(event.command, event.bytes_received) for event in events],
+                             [('players get;', 14), ('x get;', 32)])
+            self.assertIsNone(events[0].error)
+            self.assertIsInstance(events[1].error, KnuckleballException)
+            self.assertEqual(knuckleball.bulk_load('players', [1, 2]), (2, []))
+            self.assertEqual([event.command for event in events[2:]], ['players add: 1;', 'players add: 2;'])
+            with offload.ProcessParser() as process:
+                self.assertEqual(knuckleball.submit('i get;', process).result(), 42)
+            self.assertEqual((events[-1].command, events[-1].bytes_received), ('i get;', 3))
+            self.assertTrue(knuckleball.is_healthy())
+            knuckleball.close()
+
+class ShardedKnuckleballTest(unittest.TestCase):
+    def test_target(self):
+        self.assertEqual(sharding.target('  std::ages get;'), 'std::ages')
+        self.assertEqual(sharding.target('Dictionary<String, Integer> create: std::ages;'), 'std::ages')
+        self.assertEqual(sharding.target('Context listVariables;'), None)
+
+    def test_ring(self):
+        keys = ['player%d' % i for i in range(10000)]
+        ring = sharding.HashRing(['a', 'b', 'c', 'd'])
+        before = [ring.node(key) for key in keys]
+        for node in 'abcd':
+            self.assertTrue(1500 < before.count(node) < 3500)
+        ring.add('e')
+        after = [ring.node(key) for key in keys]
+        moved = [(old, new) for old, new in zip(before, after) if old != new]
+        self.assertTrue(0.1 < len(moved) / float(len(keys)) < 0.3)
+        self.assertEqual(set(new for _, new in moved), set(['e']))
+        ring.remove('e')
+        self.assertEqual([ring.node(key) for key in keys], before)
+
+    def test_execute_and_pipeline(self):
+        handler = lambda command: '"%s"' % command.split()[0]
+        with FakeServer(handler=handler) as first, FakeServer(handler=handler) as second:
+            sharded = sharding.ShardedKnuckleball([('127.0.0.1', first.port), ('127.0.0.1', second.port)])
+            variables = ['v%d' % i for i in range(100)]
+            for variable in variables:
+                self.assertEqual(sharded.execute('%s get;' % variable), variable)
+            self.assertTrue(first.commands and second.commands)
+            self.assertEqual(len(first.commands) + len(second.commands), 100)
+            with sharded.pipeline(max_commands=7) as pipeline:
+                for variable in variables:
+                    pipeline.add('%s get;' % variable)
+            self.assertEqual(pipeline.execute(), variables)
+            self.assertEqual(len(first.commands) + len(second.commands), 200)
+            self.assertRaises(KnuckleballException, sharded.execute, 'Context listVariables;')
+            self.assertEqual(sorted(sharded.execute_all('Context listVariables;').values()), ['Context', 'Context'])
+            pipeline = sharded.pipeline(max_commands=7, max_bytes=40)
+            for variable in variables[:5]:
+                pipeline.add('%s get;' % variable)
+            self.assertEqual(len(pipeline), 0) # sent once 40 bytes were queued
+            self.assertEqual(len(first.commands) + len(second.commands), 207)
+            pipeline.add('v5 get;').add('v6 get;')
+            self.assertEqual(len(pipeline), 2)
+            self.assertEqual(pipeline.execute(), variables[:7])
+            def work(worker):
+                return [sharded.execute('w%d_%d get;' % (worker, i)) for i in range(50)]
+            with concurrent.futures.ThreadPoolExecutor(8) as executor:
+                results = list(executor.map(work, range(8)))
+            self.assertEqual(results, [['w%d_%d' % (w, i) for i in range(50)] for w in range(8)])
+            sharded.close()
+
+    def test_urls(self):
+        handler = lambda command: '"%s"' % command.split()[0]
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'kb.sock')
+            with FakeServer(handler=handler) as tcp, FakeServer(handler=handler, path=path) as unix:
+                sharded = sharding.ShardedKnuckleball([('127.0.0.1', tcp.port), (unix.url, None)])
+                self.assertEqual(sorted(sharded.execute_all('Context listVariables;')), sorted([tcp.url, unix.url]))
+                variables = ['v%d' % i for i in range(100)]
+                self.assertEqual([sharded.execute('%s get;' % variable) for variable in variables], variables)
+                self.assertTrue(tcp.commands[1:] and unix.commands[1:])
+                sharded.remove_server(unix.url)
+                self.assertEqual(list(sharded.execute_all('Context listVariables;')), [tcp.url])
+                sharded.close()
+        finally:
+            os.rmdir(directory)
+
+class FailoverKnuckleballTest(unittest.TestCase):
+    def wait_until_connected(self, knuckleball):
+        for _ in range(200):
+            if all(stats['connected'] for stats in knuckleball.stats()):
+                return
+            time.sleep(0.01)
+        self.fail('not reconnected.')
+
+    def test_prefer_fastest_and_fail_over(self):
+        replies = {'Connection authenticateWithPassword: "secret";': 'null', 'x get;': '1', 'x add: 1;': 'null'}
+        with FakeServer(replies, latency_in_seconds=0.02) as slow, FakeServer(replies) as fast:
+            knuckleball = failover.FailoverKnuckleball([('127.0.0.1', slow.port), ('127.0.0.1', fast.port)],
+                                                       password='secret', backoff_in_seconds=0.01)
+            for _ in range(10):
+                self.assertEqual(knuckleball.execute('x get;'), 1)
+            self.assertEqual(slow.commands.count('x get;'), 1)
+            self.assertEqual(fast.commands.count('x get;'), 9)
+            fast.drop_connections()
+            self.assertEqual(knuckleball.execute('x get;', idempotent=True), 1)
+            self.assertEqual(slow.commands.count('x get;'), 2)
+            self.wait_until_connected(knuckleball)
+            self.assertEqual(fast.commands.count('Connection authenticateWithPassword: "secret";'), 2)
+            self.assertEqual([stats['reconnects'] for stats in knuckleball.stats()], [0, 1])
+            fast.drop_connections()
+            self.assertRaises(socket.error, knuckleball.execute, 'x add: 1;')
+            self.assertEqual(slow.commands.count('x add: 1;'), 0)
+            self.wait_until_connected(knuckleball)
+            knuckleball.close()
+
+    def test_reprobe_recovered_endpoint(self):
+        with FakeServer({'x get;': '1'}, latency_in_seconds=0.02) as slow, FakeServer({'x get;': '1'}) as fast:
+            knuckleball = failover.FailoverKnuckleball([('127.0.0.1', slow.port), ('127.0.0.1', fast.port)],
+                                                       probe_interval_in_seconds=0.05)
+            for _ in range(10):
+                knuckleball.execute('x get;')
+            self.assertEqual(slow.commands.count('x get;'), 1)
+            slow.latency_in_seconds, fast.latency_in_seconds = 0.0, 0.02
+            time.sleep(0.06)
+            for _ in range(30):
+                knuckleball.execute('x get;')
+            self.assertGreater(slow.commands.count('x get;'), 10)
+            knuckleball.close()
+
+    def test_spread_concurrent_commands(self):
+        with FakeServer({'x get;': '1'}, latency_in_seconds=0.01) as first, \
+                FakeServer({'x get;': '1'}, latency_in_seconds=0.01) as second:
+            knuckleball = failover.FailoverKnuckleball([('127.0.0.1', first.port), ('127.0.0.1', second.port)])
+            with concurrent.futures.ThreadPoolExecutor(4) as executor:
+                list(executor.map(lambda _: knuckleball.execute('x get;'), range(40)))
+            self.assertGreater(min(first.commands.count('x get;'), second.commands.count('x get;')), 10)
+            knuckleball.close()
+
+    def test_no_endpoint(self):
+        with FakeServer() as server:
+            port = server.port
+        self.assertRaises(socket.error, failover.FailoverKnuckleball, [('127.0.0.1', port)])
+
+    def test_threads_and_urls(self):
+        handler = lambda command: '"%s"' % command.split()[0]
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'kb.sock')
+            with FakeServer(handler=handler) as tcp, FakeServer(handler=handler, path=path) as unix:
+                knuckleball = failover.FailoverKnuckleball([('127.0.0.1', tcp.port), (unix.url, None)])
+                self.assertEqual([stats['endpoint'] for stats in knuckleball.stats()], [tcp.url, unix.url])
+                def work(worker):
+                    return [knuckleball.execute('w%d_%d get;' % (worker, i)) for i in range(100)]
+                with concurrent.futures.ThreadPoolExecutor(8) as executor:
+                    results = list(executor.map(work, range(8)))
+                self.assertEqual(results, [['w%d_%d' % (w, i) for i in range(100)] for w in range(8)])
+                knuckleball.close()
+        finally:
+            os.rmdir(directory)
+
+class MemoTest(unittest.TestCase):
+    def test_intern_table(self):
+        table = memo.InternTable(max_entries=5)
+        first = table.parse('(("name","Babe Ruth"),("team",ns::Yankees))')
+        second = table.parse('[ns::Yankees,"Babe","name"]')
+        self.assertIs(second[0], first['team'])
+        self.assertIs(second[2], [key for key in first if key == 'name'][0])
+        stats = table.stats()
+        self.assertEqual((stats['lookups'], stats['hits'], stats['entries']), (7, 2, 5))
+        self.assertGreater(stats['bytes_saved'], 0)
+        table.intern('full')
+        self.assertEqual(table.stats()['entries'], 1)
+
+    def test_memo_parser(self):
+        parse = memo.MemoParser(max_replies=2, max_reply_size=20, intern_table=memo.InternTable())
+        players = parse.parse('{"Babe Ruth"}')
+        self.assertEqual(players, frozenset(['Babe Ruth']))
+        self.assertIs(parse.parse('{"Babe Ruth"}'), players)
+        self.assertEqual(parse.parse('[1,2]'), (1, 2))
+        self.assertEqual(parse.parse('null'), None)
+        self.assertIsNot(parse.parse('{"Babe Ruth"}'), players) # evicted by the last two
+        self.assertEqual(parse.parse('[%s]' % ','.join(['1'] * 20)), (1,) * 20) # too long to be kept
+        self.assertRaises(KnuckleballException, parse.parse, 'RuntimeError: unknown.')
+        stats = parse.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['replies']), (1, 4, 2))
+        self.assertEqual(stats['characters_saved'], len('{"Babe Ruth"}'))
+        ages = memo.MemoParser(expect=schema.Dictionary[schema.String, schema.Integer])
+        with FakeServer({'ages get;': '(("Babe Ruth",53))'}) as server:
+            knuckleball = Knuckleball(server.host, server.port)
+            result = knuckleball.execute('ages get;', expect=ages)
+            self.assertEqual(result, {'Babe Ruth': 53})
+            self.assertRaises(TypeError, operator.setitem, result, 'X', 1)
+            self.assertIs(knuckleball.execute('ages get;', expect=ages), result)
+            knuckleball.close()
+
+    def test_memo_parser_hash_collision(self):
+        class Colliding(str):
+            def __hash__(self):
+                return 0
+        parse = memo.MemoParser()
+        self.assertEqual(parse.parse(Colliding('[1]')), (1,))
+        self.assertEqual(parse.parse(Colliding('[2]')), (2,))
+        self.assertEqual(parse.parse(Colliding('[1]')), (1,))
+        self.assertEqual(parse.stats()['hits'], 1)
+
+class TrafficTest(unittest.TestCase):
+    def test_record_and_replay(self):
+        replies = {'Connection authenticateWithPassword: "secret";': 'null', 'i get;': '42', 'name get;': '"S\u00e3o"'}
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'traffic.log')
+        try:
+            with FakeServer(replies) as server, traffic.Recorder(path) as recorder:
+                knuckleball = Knuckleball(server.host, server.port, password='secret', hooks=[recorder])
+                for _ in range(50):
+                    knuckleball.execute('i get;')
+                    knuckleball.execute('name get;')
+                self.assertRaises(KnuckleballException, knuckleball.execute, 'x get;')
+                knuckleball.close()
+            records = list(traffic.read_log(path))
+            self.assertEqual([record.command for record in records], ['i get;', 'name get;'] * 50 + ['x get;'])
+            self.assertEqual((records[0].reply_size, records[1].reply_size), (3, len('"S\u00e3o"\n'.encode('utf8'))))
+            self.assertEqual([record.error for record in records[-2:]], [False, True])
+            self.assertTrue(all(a.timestamp <= b.timestamp for a, b in zip(records, records[1:])))
+            with FakeServer(replies) as server:
+                report = traffic.replay(records, server.host, server.port, speed=None, connections=4)
+                self.assertEqual((report['commands'], report['errors']), (101, 1))
+                self.assertEqual(sorted(server.commands), sorted(record.command for record in records))
+                self.assertLessEqual(report['p50_seconds'], report['p99_seconds'])
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    traffic.main([path, server.url, '--speed', '100', '--connections', '2'])
+                self.assertEqual(json.loads(output.getvalue())['commands'], 101)
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+            os.rmdir(directory)
+
+    def test_records_pipelined_and_streamed_commands(self):
+        replies = {'i get;': '42', 'players get;': '{"Babe Ruth"}'}
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'traffic.log')
+        try:
+            with FakeServer(replies) as server, traffic.Recorder(path) as recorder:
+                knuckleball = Knuckleball(server.host, server.port, hooks=[recorder])
+                knuckleball.pipeline().add('i get;').add('players get;').execute()
+                self.assertEqual(list(knuckleball.execute_iter('players get;')), ['Babe Ruth'])
+                knuckleball.close()
+            records = list(traffic.read_log(path))
+            self.assertEqual([record.command for record in records], ['i get;', 'players get;', 'players get;'])
+            self.assertEqual([record.reply_size for record in records], [3, 14, 14])
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+            os.rmdir(directory)
+
+    def test_replay_measures_latency_from_when_commands_are_due(self):
+        records = [traffic.Record(i * 0.01, 0.0, 0, False, 'i get;') for i in range(4)]
+        with FakeServer({'i get;': '42'}, latency_in_seconds=0.1) as server:
+            report = traffic.replay(records, server.host, server.port, connections=1)
+        # Each command waits for the ones before it on the only connection.
+        self.assertEqual(report['commands'], 4)
+        self.assertGreaterEqual(report['max_seconds'], 0.3)
+        self.assertRaises(socket.error, traffic.replay, records, server.host, server.port)
+
+class ProcessParserTest(unittest.TestCase):
+    def test_parse(self):
+        big = '[%s]' % ','.join('"player %d"' % i for i in range(20000))
+        replies = {'players get;': big, 'i get;': '42', 'x get;': 'RuntimeError: unknown variable.'}
+        with FakeServer(replies) as server, offload.ProcessParser(threshold=1000, max_workers=2) as process:
+            self.assertEqual(process.parse('[1,2]'), [1, 2])
+            self.assertIsNone(process._executor)
+            self.assertEqual(process.parse(big), parser.parse(big))
+            self.assertRaises(KnuckleballException, process.parse, 'RuntimeError: ' + 'x' * 1000)
+            knuckleball = Knuckleball(server.host, server.port, spill_threshold=1 << 16)
+            self.assertEqual(knuckleball.execute('players get;', expect=process), parser.parse(big))
+            future = knuckleball.submit('players get;', process)
+            self.assertIsInstance(future, concurrent.futures.Future)
+            self.assertEqual(len(future.result()), 20000)
+            pipeline = knuckleball.pipeline()
+            for command in ('players get;', 'i get;', 'x get;', 'players get;'):
+                pipeline.add(command, expect=process)
+            results = pipeline.add('i get;').execute()
+            self.assertEqual((results[0], results[1], results[3], results[4]), (parser.parse(big), 42, results[0], 42))
+            self.assertIsInstance(results[2], KnuckleballException)
+            self.assertEqual(process.parse(big.encode('utf8')), parser.parse(big))
+            self.assertEqual(process.parse(b'"S\xc3\xa3o"'), 'S\u00e3o')
+            typed = offload.ProcessParser(threshold=1000, expect=schema.Vector[schema.Integer])
+            self.assertRaises(TypeMismatchException, knuckleball.execute, 'players get;', typed)
+            typed.close()
+            with offload.ProcessParser(threshold=1, expect=schema.Null) as null:
+                self.assertIsNone(null.parse('null'))
+            # The threshold counts bytes, whether the response is text or bytes.
+            with offload.ProcessParser(threshold=8) as small:
+                self.assertEqual(small.parse('"\u00e3\u00e3\u00e3"'), '\u00e3\u00e3\u00e3')
+                self.assertIsNotNone(small._executor)
+            knuckleball.close()
+
+    def test_execute_receives_bytes(self):
+        class Recorder:
+            def __init__(self):
+                self.received = []
+            def submit(self, data):
+                self.received.append(data)
+                future = concurrent.futures.Future()
+                future.set_result(parser.parse(data.decode('utf8')))
+                return future
+            def parse(self, data):
+                return self.submit(data).result()
+        with FakeServer({'i get;': '42'}) as server:
+            knuckleball = Knuckleball(server.host, server.port)
+            recorder = Recorder()
+            self.assertEqual(knuckleball.execute('i get;', expect=recorder), 42)
+            knuckleball.add_hook(metrics.MetricsCollector())
+            self.assertEqual(knuckleball.execute('i get;', expect=recorder), 42)
+            self.assertEqual(recorder.received, [b'42', b'42'])
+            knuckleball.close()
+
+    def test_pipeline_drains_replies_when_submit_fails(self):
+        class Broken:
+            def submit(self, data):
+                raise RuntimeError('no shared memory.')
+        with FakeServer({'i get;': '42', 'players get;': '["Babe Ruth"]'}) as server:
+            knuckleball = Knuckleball(server.host, server.port)
+            pipeline = knuckleball.pipeline()
+            pipeline.add('i get;', expect=Broken()).add('players get;').add('i get;', expect=Broken())
+            self.assertRaises(RuntimeError, pipeline.execute)
+            self.assertTrue(knuckleball.is_healthy())
+            self.assertEqual(pipeline.add('i get;').execute(), [42])
+            self.assertEqual(knuckleball.execute('i get;'), 42)
+            knuckleball.close()
+
+class SchemaTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(schema.Null.parse('null'), None)
+        self.assertEqual(schema.Boolean.parse('false'), False)
+        self.assertEqual(schema.Character.parse("'\"'"), '"')
+        self.assertEqual(schema.Integer.parse('-42'), -42)
+        self.assertEqual(schema.Float.parse('42'), 42.0)
+        self.assertEqual(schema.String.parse('"knuckle\\"ball"'), 'knuckle"ball')
+        self.assertEqual(schema.Vector[schema.Integer].parse('[]'), [])
+        self.assertEqual(schema.Vector[schema.Integer].parse('[-42,0,+42,]'), [-42, 0, 42])
+        self.assertEqual(schema.Vector[schema.Name].parse('[i,prices,std::ages]'), ['i', 'prices', 'std::ages'])
+        self.assertEqual(schema.Vector[schema.Character].parse("[',',']']"), [',', ']'])
+        self.assertEqual(schema.Set[schema.String].parse('{"a,b","c\\"d",""}'), set(['a,b', 'c"d', '']))
+        self.assertEqual(schema.Dictionary[schema.String, schema.Float].parse('(("a",-42.0),("b,)",42.0,))'),
+                         {'a': -42.0, 'b,)': 42.0})
+        self.assertIs(schema.Vector[schema.Integer], schema.Vector[schema.Integer])
+        self.assertEqual(repr(schema.Dictionary[schema.String, schema.Integer]), 'Dictionary<String, Integer>')
+
+    def test_mismatch(self):
+        mismatches = [
+            (schema.Null, 'true'),
+            (schema.Integer, '4.2'),
+            (schema.String, '"a"b"'),
+            (schema.Vector[schema.Integer], '{1}'),
+            (schema.Vector[schema.Integer], '[1,,2]'),
+            (schema.Set[schema.Boolean], '{true,1}'),
+            (schema.Dictionary[schema.Integer, schema.Integer], '((1,2,3))'),
+        ]
+        for expected, data in mismatches:
+            self.assertRaises(TypeMismatchException, expected.parse, data)
+        try:
+            schema.Vector[schema.Integer].parse('RuntimeError: invalid message.')
+        except KnuckleballException as e:
+            self.assertNotIsInstance(e, TypeMismatchException)
+            self.assertEqual(str(e), 'RuntimeError: invalid message.')
+        self.assertRaises(TypeError, lambda: schema.Vector[schema.Vector[schema.Integer]])
+
+    def test_array(self):
+        self.assertEqual(schema.Array[schema.Integer].parse('[]'), array.array('q'))
+        self.assertEqual(schema.Array[schema.Integer].parse('[-42,0,+42,]'), array.array('q', [-42, 0, 42]))
+        self.assertEqual(schema.Array[schema.Float].parse('{-42.5,0,42.0}'), array.array('d', [-42.5, 0.0, 42.0]))
+        data = '[%s]' % ','.join(str(i) for i in range(100000))
+        self.assertEqual(schema.Array[schema.Integer].parse(data), array.array('q', range(100000)))
+        for data in ('[1,,2]', '[,]', '[1 ,2]', '[1,2,x]', '[1.5]', '(1,2)', data[:-1] + ',,]', '[9223372036854775808]'):
+            self.assertRaises(TypeMismatchException, schema.Array[schema.Integer].parse, data)
+        self.assertEqual(schema.Array[schema.Integer].parse('[-9223372036854775808]'), array.array('q', [-2 ** 63]))
+        self.assertEqual(schema.Array[schema.Integer].parse('[0000000000000000000042]'), array.array('q', [42]))
+        # Without NumPy, elements are decoded one at a time into the same array.
+        decoder = schema.ArrayType(schema.Integer)
+        decoder._dtype = None
+        self.assertEqual(decoder.parse('[-42,0,+42,]'), array.array('q', [-42, 0, 42]))
+        self.assertRaises(TypeMismatchException, decoder.parse, '[9223372036854775808]')
+        self.assertRaises(TypeError, lambda: schema.Array[schema.String])
+
+    @unittest.skipIf(schema.numpy is None, 'NumPy is not installed.')
+    def test_ndarray(self):
+        values = schema.NDArray[schema.Integer].parse('[-42,0,+42,]')
+        self.assertEqual(values.dtype, schema.numpy.int64)
+        self.assertEqual(values.tolist(), [-42, 0, 42])
+        self.assertEqual(schema.NDArray[schema.Float].parse('{}').tolist(), [])
+        data = '[%s]' % ','.join(str(i / 8.0) for i in range(100000))
+        self.assertEqual(schema.NDArray[schema.Float].parse(data).tolist(), [i / 8.0 for i in range(100000)])
+        self.assertEqual(schema.NDArray[schema.Integer].parse('[]').dtype, schema.numpy.int64)
+        self.assertEqual(schema.NDArray[schema.Integer].parse('[9223372036854775807]').tolist(), [2 ** 63 - 1])
+        self.assertEqual(schema.NDArray[schema.Integer].parse('[-0000000000000000000042]').tolist(), [-42])
+        values = [i * 92233720368547 for i in range(-50000, 50000)]
+        data = '{%s}' % ','.join(map(str, values))
+        self.assertEqual(schema.NDArray[schema.Integer].parse(data).tolist(), values)
+        for data in ('[1,x]', '[1,,2]', '[,]', '[1 ,2]', '[1.5]', '[\u0661]', '[99999999999999999999]',
+                     '[-9223372036854775809]'):
+            self.assertRaises(TypeMismatchException, schema.NDArray[schema.Integer].parse, data)
+        self.assertRaises(TypeMismatchException, schema.NDArray[schema.Float].parse, '[1,x]')
+        self.assertRaises(KnuckleballException, schema.NDArray[schema.Float].parse, 'ERROR: no such variable.')
+
+    def test_lazy(self):
+        vector = schema.Lazy.parse('[1,"a,\\"b\\"",\'é\',2.5,true,ns::v,"ü",]')
+        self.assertIsInstance(vector, lazy.LazyVector)
+        self.assertEqual(len(vector), 7)
+        self.assertEqual((vector[1], vector[2], vector[-1], vector[1:3]), ('a,"b"', 'é', 'ü', ['a,"b"', 'é']))
+        self.assertEqual(vector, [1, 'a,"b"', 'é', 2.5, True, 'ns::v', 'ü'])
+        self.assertIn(2.5, vector)
+        self.assertRaises(IndexError, lambda: vector[7])
+        players = schema.Lazy.parse('{"Babe Ruth","David Ortiz"}')
+        self.assertEqual((len(players), 'Babe Ruth' in players, 'X' in players), (2, True, False))
+        self.assertEqual(players, set(['Babe Ruth', 'David Ortiz']))
+        ages = schema.Lazy.parse('(("Babe Ruth",53),("Dé",2.5,),)')
+        self.assertEqual((len(ages), ages['Dé'], ages.get('X')), (2, 2.5, None))
+        self.assertEqual(ages, {'Babe Ruth': 53, 'Dé': 2.5})
+        self.assertFalse(hasattr(vector, '__dict__'))
+        self.assertEqual(schema.Lazy.parse('42'), 42)
+        self.assertEqual(schema.Lazy.parse_bytes(b'42'), 42)
+        self.assertEqual(schema.Lazy.parse_bytes(b'[1,"\xc3\xa9"]'), [1, '\u00e9'])
+        self.assertRaises(KnuckleballException, schema.Lazy.parse_bytes, b'[ns::\xc3\xa9,x\xe2\x82\xac]')
+        self.assertRaises(KnuckleballException, schema.Lazy.parse, '[1,,2]')
+        for data in ('[ns::é,x€]', '(("a",1),(x€,2))', '{"é",}x}'):
+            self.assertRaises(KnuckleballException, schema.Lazy.parse, data)
+
+    def test_parse_matches_parser(self):
+        rng = random.Random(3)
+        values = [[rng.randrange(-1000, 1000) for _ in range(rng.randrange(50))] for _ in range(100)]
+        for value in values:
+            data = serializer.serialize(value)
+            self.assertEqual(schema.Vector[schema.Integer].parse(data), parser.parse(data))
+            self.assertEqual(schema.Set[schema.Integer].parse(data.replace('[', '{').replace(']', '}')),
+                             set(value))
+
+class ParserTest(unittest.TestCase):
+    ALPHABET = 'ab_Z09+-.,:\'"\\()[]{} '
+
+    def random_element(self, rng):
+        kind = rng.randrange(7)
+        if kind == 0:
+            return rng.choice(['true', 'false'])
+        if kind == 1:
+            return "'%s'" % rng.choice(self.ALPHABET)
+        if kind == 2:
+            return rng.choice(['', '+', '-']) + str(rng.randrange(1000))
+        if kind == 3:
+            return '%s%d.%s' % (rng.choice(['', '+', '-']), rng.randrange(100), rng.choice(['0', '5', '001', '99']))
+        if kind == 4:
+            chars = [rng.choice(['\\"', 'a', ' ', ',', '(', ')', ']', '}', "'", '\\']) for _ in range(rng.randrange(6))]
+            return '"%s"' % ''.join(chars)
+        if kind == 5:
+            return rng.choice(['i', 'prices', 'null', 'a_1', 'std::ages', 'ns::x9'])
+        return rng.choice(['"knuckle\\"ball"', "','", "')'", '"a,b"', '"(1,2)"'])
+
+    def random_value(self, rng):
+        kind = rng.randrange(5)
+        elements = [self.random_element(rng) for _ in range(rng.randrange(5))]
+        trailing = rng.choice(['', '', ','])
+        if kind == 0:
+            return '[%s%s]' % (','.join(elements), trailing if elements else '')
+        if kind == 1:
+            return '{%s%s}' % (','.join(elements), trailing if elements else '')
+        if kind == 2:
+            pairs = ['(%s,%s%s)' % (self.random_element(rng), self.random_element(rng), rng.choice(['', ',']))
+                     for _ in range(rng.randrange(4))]
+            return '(%s%s)' % (','.join(pairs), trailing if pairs else '')
+        if kind == 3:
+            return rng.choice(['null', 'RuntimeError: unknown error.', 'AuthenticationError: wrong password.'])
+        return self.random_element(rng)
+
+    def mutate(self, rng, data):
+        pos = rng.randrange(len(data) + 1)
+        operation = rng.randrange(3)
+        if operation == 0:
+            return data[:pos] + rng.choice(self.ALPHABET) + data[pos:]
+        if operation == 1:
+            return data[:pos] + data[pos + 1:]
+        return data[:pos] + rng.choice(self.ALPHABET) + data[pos + 1:]
+
+    def outcome(self, parse, data):
+        "Return the parsed value with its types spelled out, or the message of the raised KnuckleballException."
+        def typed(value):
+            if isinstance(value, list):
+                return ('list', [typed(v) for v in value])
+            if isinstance(value, set):
+                return ('set', sorted(repr(typed(v)) for v in value))
+            if isinstance(value, dict):
+                return ('dict', sorted(repr((typed(k), typed(v))) for k, v in value.items()))
+            return (type(value).__name__, value)
+        try:
+            return typed(parse(data))
+        except KnuckleballException as e:
+            return ('error', str(e))
+
+    def assertSameOutcome(self, data):
+        try:
+            expected = self.outcome(LegacyParser.parse, data)
+        except ValueError:
+            return # the legacy parser accepts malformed floats such as '1.-2' and fails to convert them
+        self.assertEqual(self.outcome(parser.parse, data), expected, data)
+
+    def test_parse_matches_legacy_parser(self):
+        rng = random.Random(1729)
+        for _ in range(3000):
+            self.assertSameOutcome(self.random_value(rng))
+
+    def test_parse_matches_legacy_parser_on_malformed_responses(self):
+        rng = random.Random(42)
+        for _ in range(3000):
+            data = self.random_value(rng)
+            for _ in range(rng.randrange(1, 4)):
+                data = self.mutate(rng, data)
+            self.assertSameOutcome(data)
+
+    def test_iterparse_matches_parse(self):
+        rng = random.Random(7)
+        for _ in range(3000):
+            data = self.random_value(rng)
+            if rng.randrange(2):
+                data = self.mutate(rng, data)
+            cuts = sorted(rng.randrange(len(data) + 1) for _ in range(rng.randrange(4)))
+            chunks = [data[i:j] for i, j in zip([0] + cuts, cuts + [len(data)])]
+            expected = self.outcome(parser.parse, data)
+            if expected[0] not in ('list', 'set', 'dict'):
+                self.assertEqual(self.outcome(lambda data: list(parser.iterparse(chunks)), data)[0], 'error', data)
+                continue
+            container = {'list': list, 'set': set, 'dict': dict}[expected[0]]
+            self.assertEqual(self.outcome(lambda data: container(parser.iterparse(chunks)), data), expected, data)
+
+    def test_iterparse_takes_linear_time(self):
+        def seconds(size):
+            data = '["%s",1]' % ('x,\\"' * (size // 4))
+            chunks = [data[i:i + 4096] for i in range(0, len(data), 4096)]
+            started = time.time()
+            self.assertEqual(list(parser.iterparse(chunks)), ['x,"' * (size // 4), 1])
+            return time.time() - started
+        # A quadratic parser takes 64 times as long for 8 times the data.
+        small, large = seconds(1 << 20), seconds(8 << 20)
+        self.assertLess(large, 20 * max(small, 0.01))
+
+    def test_lazy_matches_parse(self):
+        rng = random.Random(11)
+        def parse(data):
+            value = schema.Lazy.parse(data)
+            for container, build in ((lazy.LazyVector, list), (lazy.LazySet, set), (lazy.LazyDictionary, dict)):
+                if isinstance(value, container):
+                    return build(value)
+            return value
+        for _ in range(3000):
+            data = self.random_value(rng)
+            if rng.randrange(2):
+                data = self.mutate(rng, data)
+            self.assertEqual(self.outcome(parse, data), self.outcome(parser.parse, data), data)
+
+    def spill(self, data):
+        with tempfile.TemporaryFile() as f:
+            f.write(data.encode('utf8'))
+            f.flush()
+            return connection.Spill(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def test_spill_matches_parse(self):
+        rng = random.Random(13)
+        def parse_lazy(data):
+            value = schema.Lazy.parse_spill(self.spill(data))
+            for container, build in ((lazy.LazyVector, list), (lazy.LazySet, set), (lazy.LazyDictionary, dict)):
+                if isinstance(value, container):
+                    return build(value)
+            return value
+        parse = lambda data: Knuckleball._parse(self.spill(data), None)
+        for _ in range(3000):
+            data = self.random_value(rng)
+            if rng.randrange(2):
+                data = self.mutate(rng, data) or '[]'
+            expected = self.outcome(parser.parse, data)
+            self.assertEqual(self.outcome(parse, data), expected, data)
+            self.assertEqual(self.outcome(parse_lazy, data), expected, data)
+        for data in ('[é,ns::ü,"ü",\'é\']', '((é,"ü"),)', '[é€]', '[1,€]', '((€,1))'):
+            self.assertEqual(self.outcome(parse_lazy, data), self.outcome(parser.parse, data), data)
+
+    def test_close_lazy_spill(self):
+        for data in ('[1,"a"]', '{1,2}', '((1,"a"),(2,"b"))'):
+            spill = self.spill(data)
+            with schema.Lazy.parse_spill(spill) as value:
+                self.assertEqual(len(value), 2)
+            self.assertTrue(spill.buffer.closed)
+            self.assertRaises(ValueError, list, value)
+        value = schema.Lazy.parse('[1,2]')
+        value.close()
+        self.assertEqual(value, [1, 2])
+
+    def test_parse_large_set(self):
+        data = '{%s}' % ','.join('"player %d"' % i for i in range(50000))
+        self.assertEqual(len(Knuckleball.parse(data)), 50000)
+        self.assertRaises(KnuckleballException, Knuckleball.parse, data[:-2] + ',}')
+
 if __name__ == '__main__':
     unittest.main()